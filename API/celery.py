@@ -1,6 +1,7 @@
 import os
 from celery import Celery
 from celery.schedules import crontab
+from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'API.settings')
 app = Celery('API')
@@ -52,6 +53,13 @@ app.conf.beat_schedule = {
     },
 }
 
+# The buffer is only written when CREDIT_USAGE_LOG_BUFFERED is on
+if settings.CREDIT_USAGE_LOG_BUFFERED:
+    app.conf.beat_schedule['flush-credit-usage-logs'] = {
+        'task': 'subscription.tasks.flush_credit_usage_logs',
+        'schedule': 5.0,  # Run every 5 seconds
+    }
+
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}') 
@@ -89,7 +89,8 @@ WSGI_APPLICATION = 'API.wsgi.application'
 DATABASES = {
     'default': dj_database_url.config(
         default=os.getenv('DATABASE_URL'),
-        conn_max_age=600
+        conn_max_age=600,
+        conn_health_checks=True
     )
 }
 
@@ -317,6 +318,11 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        'subscription': {
+            'handlers': ['console', 'file'],
+            'level': 'DEBUG' if DEBUG else 'INFO',
+            'propagate': False,
+        },
     }
 }
 
@@ -326,12 +332,35 @@ CELERY_RESULT_BACKEND = CELERY_BROKER_URL
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+# Stripe webhooks get their own workers so an event replay can't starve emails and beat jobs
+CELERY_TASK_ROUTES = {
+    'subscription.tasks.handle_stripe_event': {'queue': 'stripe_webhooks'},
+}
 
 # Redis configuration for chat and notifications
 REDIS_URL = os.getenv('REDIS_URL')
 
+# Cache - shared Redis cache when available, per-process memory otherwise
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Queue credit usage log rows in Redis and bulk-insert them from Celery beat
+CREDIT_USAGE_LOG_BUFFERED = os.getenv('CREDIT_USAGE_LOG_BUFFERED', 'False').lower() == 'true'
+
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+STRIPE_TIMEOUT = int(os.getenv('STRIPE_TIMEOUT', '10'))  # seconds per Stripe API request
 
 # Frontend URL for redirects
 FRONTEND_URL = os.getenv('FRONTEND_URL')
@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-16 23:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0003_user_email_verified_alter_user_is_active_otp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='stripe_customer_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
@@ -35,6 +35,7 @@ class User(AbstractBaseUser, PermissionsMixin):
     deletion_requested_at = models.DateTimeField(null=True, blank=True)
     is_pending_deletion = models.BooleanField(default=False)
     email_verified = models.BooleanField(default=False)  # New field for email verification status
+    stripe_customer_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
 
     objects = CustomUserManager()
 
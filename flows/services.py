@@ -6,7 +6,7 @@ import logging
 import json
 import redis
 from django.conf import settings
-import time
+import uuid
 
 logger = logging.getLogger(__name__)
 
@@ -202,7 +202,7 @@ class FlowExecutionService:
                         input_tokens=total_input_tokens,
                         output_tokens=total_output_tokens,
                         bot_id=engine.context.get("bot_id"),
-                        request_id=f"flow_{engine.context.get('flow_id')}_{int(time.time())}"
+                        request_id=f"flow_{engine.context.get('flow_id')}_{uuid.uuid4().hex}"
                     )
                     
                     logger.info(f"Credits deducted for flow execution: {deduction_result['credits_deducted']} credits")
@@ -49,6 +49,10 @@ class WebhookEventAdmin(admin.ModelAdmin):
     list_filter = ('event_type', 'processed_at')
     search_fields = ('stripe_event_id', 'event_type')
     readonly_fields = ('processed_at',)
+    
+    def get_queryset(self, request):
+        # The changelist never shows the event payload; the change form loads it on demand
+        return super().get_queryset(request).defer('data')
 
 # Credit System Admin
 @admin.register(AIModel)
@@ -0,0 +1,15 @@
+from rest_framework.views import exception_handler
+from rest_framework.response import Response
+import logging
+
+logger = logging.getLogger(__name__)
+
+def billing_exception_handler(exc, context):
+    """Log unexpected errors from the credit and billing views in one place and return a JSON 500"""
+    response = exception_handler(exc, context)
+    if response is not None:
+        return response
+    
+    view = context.get('view')
+    logger.exception(f"Unhandled error in {view.__class__.__name__ if view else 'API view'}: {exc}")
+    return Response({'error': 'Internal server error'}, status=500)
@@ -0,0 +1,23 @@
+# Generated by Django 5.0 on 2026-10-16 21:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0010_alter_subscriptionplan_plan_type'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='creditusagelog',
+            index=models.Index(fields=['user', '-created_at'], name='cul_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='creditusagelog',
+            index=models.Index(fields=['-created_at'], name='cul_created_idx'),
+        ),
+    ]
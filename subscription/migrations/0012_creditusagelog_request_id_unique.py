@@ -0,0 +1,42 @@
+# Generated by Django 5.0 on 2026-10-16 22:40
+
+from django.db import migrations, models
+
+
+def clear_colliding_request_ids(apps, schema_editor):
+    # Rows logged without a request_id must not collide under the new constraint
+    CreditUsageLog = apps.get_model('subscription', 'CreditUsageLog')
+    CreditUsageLog.objects.filter(request_id='').update(request_id=None)
+    
+    # Flow runs used to build request IDs from a per-second timestamp, so some users
+    # have several charges under one ID; keep the first one keyed and the rest as plain logs
+    duplicates = (
+        CreditUsageLog.objects.exclude(request_id=None)
+        .values('user_id', 'request_id')
+        .annotate(first_id=models.Min('id'), rows=models.Count('id'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        CreditUsageLog.objects.filter(
+            user_id=duplicate['user_id'], request_id=duplicate['request_id']
+        ).exclude(id=duplicate['first_id']).update(request_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0011_creditusagelog_created_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='creditusagelog',
+            name='request_id',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.RunPython(clear_colliding_request_ids, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='creditusagelog',
+            constraint=models.UniqueConstraint(fields=('user', 'request_id'), name='cul_user_request_id_uniq'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.0 on 2026-10-16 23:10
+
+from django.db import migrations
+
+
+def copy_customer_ids_to_users(apps, schema_editor):
+    # Webhooks now resolve users by User.stripe_customer_id; seed it from existing subscriptions
+    Subscription = apps.get_model('subscription', 'Subscription')
+    User = apps.get_model('account', 'User')
+    linked_users, linked_customers = set(), set()
+    rows = (
+        Subscription.objects.exclude(stripe_customer_id__isnull=True)
+        .exclude(stripe_customer_id='')
+        .exclude(stripe_customer_id__startswith='trial_')
+        .order_by('-created_at')
+        .values_list('user_id', 'stripe_customer_id')
+    )
+    for user_id, customer_id in rows:
+        # Keep each user's latest customer, and never give one customer to two users
+        if user_id in linked_users or customer_id in linked_customers:
+            continue
+        linked_users.add(user_id)
+        linked_customers.add(customer_id)
+        User.objects.filter(pk=user_id, stripe_customer_id__isnull=True).update(stripe_customer_id=customer_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0004_user_stripe_customer_id'),
+        ('subscription', '0012_creditusagelog_request_id_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_customer_ids_to_users, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0 on 2026-10-16 23:13
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0013_backfill_user_stripe_customer_id'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['stripe_customer_id'], name='sub_stripe_customer_idx'),
+        ),
+    ]
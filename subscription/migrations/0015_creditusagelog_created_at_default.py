@@ -0,0 +1,19 @@
+# Generated by Django 5.0 on 2026-10-16 23:52
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscription', '0014_subscription_stripe_customer_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='creditusagelog',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
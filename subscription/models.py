@@ -6,7 +6,7 @@ import stripe
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
 class WebhookEvent(models.Model):
-    """Track processed webhook events to prevent duplicates"""
+    """Stripe events claimed by the webhook view; the unique event ID dedupes redeliveries"""
     stripe_event_id = models.CharField(max_length=255, unique=True, db_index=True)
     event_type = models.CharField(max_length=100)
     processed_at = models.DateTimeField(auto_now_add=True)
@@ -85,6 +85,11 @@ class Subscription(models.Model):
     is_trial_user = models.BooleanField(default=False)
     trial_credits_allocated = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['stripe_customer_id'], name='sub_stripe_customer_idx'),
+        ]
+
     @property
     def is_active(self):
         return self.status in ['trialing', 'active']
@@ -231,28 +236,45 @@ class UserCreditBalance(models.Model):
         return self.credits_remaining >= required_credits
     
     def deduct_credits(self, credits_to_deduct):
-        """Deduct credits from balance"""
+        """Deduct credits from balance with a single conditional UPDATE"""
         from decimal import Decimal
+        import math
         
-        # Convert to Decimal for comparison, then to int for storage
+        # Integer storage: the balance loses the rounded-up amount and usage
+        # gains the rounded-down amount, same as truncating the Decimal result
         credits_to_deduct_decimal = Decimal(str(credits_to_deduct))
-        credits_remaining_decimal = Decimal(str(self.credits_remaining))
+        credits_charged = math.ceil(credits_to_deduct_decimal)
+        credits_used = math.floor(credits_to_deduct_decimal)
         
-        if credits_remaining_decimal >= credits_to_deduct_decimal:
-            self.credits_remaining = int(credits_remaining_decimal - credits_to_deduct_decimal)
-            self.credits_used_this_period = int(Decimal(str(self.credits_used_this_period)) + credits_to_deduct_decimal)
-            self.save()
-            return True
-        return False
+        # The WHERE clause guards against overdraft, so concurrent deductions
+        # never read-modify-write a stale balance
+        updated = UserCreditBalance.objects.filter(
+            pk=self.pk,
+            credits_remaining__gte=credits_charged
+        ).update(
+            credits_remaining=models.F('credits_remaining') - credits_charged,
+            credits_used_this_period=models.F('credits_used_this_period') + credits_used,
+            updated_at=timezone.now()
+        )
+        if not updated:
+            self.refresh_from_db(fields=['credits_remaining'])
+            return False
+        
+        self.refresh_from_db(fields=['credits_remaining', 'credits_used_this_period', 'updated_at'])
+        return True
     
     def add_credits(self, credits_to_add):
-        """Add credits to balance"""
+        """Add credits to balance with a single UPDATE"""
         from decimal import Decimal
         
-        # Convert to Decimal for calculation, then to int for storage
-        credits_to_add_decimal = Decimal(str(credits_to_add))
-        self.credits_remaining = int(Decimal(str(self.credits_remaining)) + credits_to_add_decimal)
-        self.save()
+        # Integer storage, same truncation as before; the increment happens in the
+        # database so concurrent adjustments can't overwrite each other
+        credits_added = int(Decimal(str(credits_to_add)))
+        UserCreditBalance.objects.filter(pk=self.pk).update(
+            credits_remaining=models.F('credits_remaining') + credits_added,
+            updated_at=timezone.now()
+        )
+        self.refresh_from_db(fields=['credits_remaining', 'updated_at'])
         return True
     
     def reset_trial_credits(self):
@@ -274,11 +296,21 @@ class CreditUsageLog(models.Model):
     output_tokens = models.IntegerField()
     cost_usd = models.DecimalField(max_digits=10, decimal_places=6)
     credits_deducted = models.DecimalField(max_digits=10, decimal_places=6)
-    request_id = models.CharField(max_length=100, blank=True)  # For tracking specific requests
-    created_at = models.DateTimeField(auto_now_add=True)
+    request_id = models.CharField(max_length=100, null=True, blank=True)  # Client idempotency key
+    # Not auto_now_add, so rows bulk-inserted from the Redis buffer keep their deduction time
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='cul_user_created_idx'),
+            # Unfiltered admin listings page the whole table newest first
+            models.Index(fields=['-created_at'], name='cul_created_idx'),
+        ]
+        constraints = [
+            # A retried request_id finds the original row instead of deducting twice
+            models.UniqueConstraint(fields=['user', 'request_id'], name='cul_user_request_id_uniq'),
+        ]
     
     def __str__(self):
         return f"{self.user.email} - {self.model.name} - {self.credits_deducted} credits"
@@ -1,16 +1,98 @@
+import json
+import time
 import stripe
 from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import OperationalError, transaction
 from django.utils import timezone
 from datetime import timedelta
 import logging
 from django.db import models
 from datetime import datetime, timezone as dt_timezone
-from .models import Invoice, Subscription
+from functools import wraps
+from django.contrib.auth import get_user_model
+from .models import Invoice, Subscription, SubscriptionPlan, PaymentMethod
 from subscription.models import UserCreditBalance
 
 logger = logging.getLogger(__name__)
 
+User = get_user_model()
+
 stripe.api_key = settings.STRIPE_SECRET_KEY
+# Bound every Stripe call so a slow API response can't pin a worker (library default is 80s)
+stripe.default_http_client = stripe.RequestsClient(timeout=settings.STRIPE_TIMEOUT)
+
+# How long a user's credit summary may be served from cache
+CREDIT_SUMMARY_CACHE_TTL = 10
+
+# Serialized active plan list; cleared whenever a plan is saved or deleted
+SUBSCRIPTION_PLANS_CACHE_KEY = 'subscription_plans_active_v2'
+SUBSCRIPTION_PLANS_CACHE_TTL = 3600
+
+# Every plan keyed by Stripe price ID, for webhook lookups; cleared alongside the plan list
+SUBSCRIPTION_PLANS_BY_PRICE_CACHE_KEY = 'subscription_plans_by_price_v1'
+
+# Fixed per deploy, so built once instead of on every balance fetch and deduction
+TRIAL_MODEL_RESTRICTIONS = {
+    'allowed_models': ('gpt-4o-mini',),
+    'restricted_models': ('gpt-4o', 'claude-3-sonnet', 'claude-3-haiku', 'claude-3-opus', 'gemini-pro', 'gemini-pro-vision')
+}
+
+# Redis list holding usage log rows waiting for flush_credit_usage_logs
+CREDIT_USAGE_LOG_BUFFER_KEY = 'credit_usage_log_buffer'
+
+# Redis list holding buffered usage log rows that could not be inserted, kept for inspection
+CREDIT_USAGE_LOG_DEAD_LETTER_KEY = 'credit_usage_log_dead_letter'
+
+# Webhooks keep subscriptions current; rows untouched for longer get a background re-sync
+SUBSCRIPTION_SYNC_MAX_AGE = timedelta(hours=1)
+
+# Stripe subscription objects reused across a burst of webhooks; dropped when Stripe reports a change
+STRIPE_SUBSCRIPTION_CACHE_KEY = 'stripe_sub:{subscription_id}'
+STRIPE_SUBSCRIPTION_CACHE_TTL = 300
+
+def stripe_timestamp(value):
+    """Convert a Stripe epoch timestamp to an aware UTC datetime, or None if unset"""
+    return datetime.fromtimestamp(value, tz=dt_timezone.utc) if value else None
+
+# Stripe reads retried on rate limits and dropped connections; backoff doubles per attempt up to the cap
+STRIPE_READ_ATTEMPTS = 3
+STRIPE_RETRY_MAX_DELAY = 8
+
+def stripe_retry(fn):
+    """Retry a Stripe read with exponential backoff, honouring Retry-After"""
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        for attempt in range(STRIPE_READ_ATTEMPTS):
+            try:
+                return fn(*args, **kwargs)
+            except (stripe.error.RateLimitError, stripe.error.APIConnectionError) as e:
+                if attempt == STRIPE_READ_ATTEMPTS - 1:
+                    raise
+                # Retry-After may also be an HTTP-date; anything but seconds falls back to the backoff
+                try:
+                    delay = float((e.headers or {}).get('Retry-After'))
+                except (TypeError, ValueError):
+                    delay = 2 ** attempt
+                delay = min(delay, STRIPE_RETRY_MAX_DELAY)
+                logger.warning(f"Stripe read failed ({e.__class__.__name__}), retrying in {delay}s")
+                time.sleep(delay)
+    return inner
+
+# Webhook failures worth another attempt; handlers let these reach handle_stripe_event so Celery
+# retries the event, since the claimed WebhookEvent makes Stripe's own redelivery a no-op
+TRANSIENT_WEBHOOK_ERRORS = (stripe.error.APIConnectionError, stripe.error.RateLimitError, OperationalError)
+
+SUBSCRIPTION_DATE_FIELDS = ('current_period_start', 'current_period_end', 'trial_start', 'trial_end')
+
+def stripe_subscription_dates(stripe_subscription):
+    """Period and trial fields for a local Subscription; a missing period starts now and runs 30 days"""
+    dates = {field: stripe_timestamp(stripe_subscription.get(field)) for field in SUBSCRIPTION_DATE_FIELDS}
+    now = timezone.now()
+    dates['current_period_start'] = dates['current_period_start'] or now
+    dates['current_period_end'] = dates['current_period_end'] or now + timedelta(days=30)
+    return dates
 
 class StripeService:
     @staticmethod
@@ -22,16 +104,20 @@ class StripeService:
                 name=user.full_name,
                 metadata={'user_id': user.id}
             )
+            # Remember the customer on the user so webhooks can resolve it without calling Stripe
+            User.objects.filter(pk=user.pk).update(stripe_customer_id=customer.id)
+            user.stripe_customer_id = customer.id
             return customer
         except stripe.error.StripeError as e:
             raise Exception(f"Failed to create Stripe customer: {str(e)}")
 
     @staticmethod
-    def create_subscription(user, plan, payment_method_id=None, trial_from_plan=True):
+    def create_subscription(user, plan, payment_method_id=None, trial_from_plan=True, customer=None):
         """Create a subscription in Stripe"""
         try:
-            # Get or create customer
-            customer = StripeService.get_or_create_customer(user)
+            # Reuse the caller's customer when it already has one
+            if customer is None:
+                customer = StripeService.get_or_create_customer(user)
             
             # Prepare subscription data
             subscription_data = {
@@ -47,7 +133,8 @@ class StripeService:
             if trial_from_plan and plan.trial_days > 0:
                 subscription_data['trial_period_days'] = plan.trial_days
             
-            # Add payment method if provided
+            # Add payment method if provided; it becomes the subscription's default,
+            # so the customer's invoice settings don't need a separate update
             if payment_method_id:
                 subscription_data['default_payment_method'] = payment_method_id
             
@@ -62,15 +149,12 @@ class StripeService:
                     'plan': plan,
                     'stripe_customer_id': customer.id,
                     'status': stripe_subscription.status,
-                    'current_period_start': datetime.fromtimestamp(stripe_subscription.get('current_period_start'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_start') else timezone.now(),
-                    'current_period_end': datetime.fromtimestamp(stripe_subscription.get('current_period_end'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_end') else timezone.now() + timedelta(days=30),
-                    'trial_start': datetime.fromtimestamp(stripe_subscription.get('trial_start'), tz=dt_timezone.utc) if stripe_subscription.get('trial_start') else None,
-                    'trial_end': datetime.fromtimestamp(stripe_subscription.get('trial_end'), tz=dt_timezone.utc) if stripe_subscription.get('trial_end') else None,
+                    **stripe_subscription_dates(stripe_subscription),
                 }
             )
             
             if not created:
-                print(f"Subscription {stripe_subscription.id} already exists, returning existing")
+                logger.info(f"Subscription {stripe_subscription.id} already exists, returning existing")
             
             return subscription
             
@@ -83,25 +167,25 @@ class StripeService:
     def upgrade_subscription(user, new_plan, payment_method_id=None):
         """Upgrade an existing subscription with proration"""
         try:
-            print(f"Starting upgrade for user {user.id} to plan {new_plan.id}")
+            logger.info(f"Starting upgrade for user {user.id} to plan {new_plan.id}")
             
             # Get current active subscription
             current_subscription = Subscription.objects.filter(user=user, status__in=['trialing', 'active']).first()
             if not current_subscription:
                 raise Exception("No active subscription to upgrade.")
             
-            print(f"Found current subscription: {current_subscription.id}")
+            logger.debug(f"Found current subscription: {current_subscription.id}")
             
             # Get current subscription to verify it exists and get items
-            print(f"Retrieving Stripe subscription: {current_subscription.stripe_subscription_id}")
+            logger.debug(f"Retrieving Stripe subscription: {current_subscription.stripe_subscription_id}")
             stripe_subscription = stripe.Subscription.retrieve(current_subscription.stripe_subscription_id)
-            print(f"Stripe subscription retrieved: {stripe_subscription.id}")
+            logger.debug(f"Stripe subscription retrieved: {stripe_subscription.id}")
             
             # Get the existing subscription item ID using the correct approach
-            print("Getting existing subscription items...")
+            logger.debug("Getting existing subscription items...")
             # Access items directly from the subscription object
             subscription_items = stripe_subscription['items']['data']
-            print(f"Found {len(subscription_items)} subscription items")
+            logger.debug(f"Found {len(subscription_items)} subscription items")
             
             if not subscription_items:
                 raise Exception("No subscription items found.")
@@ -109,8 +193,8 @@ class StripeService:
             # Get the first (and usually only) subscription item
             existing_item = subscription_items[0]
             existing_item_id = existing_item['id']
-            print(f"Existing item ID: {existing_item_id}")
-            print(f"New plan price ID: {new_plan.stripe_price_id}")
+            logger.debug(f"Existing item ID: {existing_item_id}")
+            logger.debug(f"New plan price ID: {new_plan.stripe_price_id}")
             
             # Determine if this is an upgrade or downgrade based on price
             current_price = current_subscription.plan.price if current_subscription.plan else 0
@@ -121,14 +205,14 @@ class StripeService:
             if is_upgrade:
                 # For upgrades: immediately invoice the prorated amount so user gets immediate access
                 proration_behavior = 'always_invoice'
-                print(f"This is an upgrade (${current_price} → ${new_price}). Using 'always_invoice' for immediate access.")
+                logger.debug(f"This is an upgrade (${current_price} → ${new_price}). Using 'always_invoice' for immediate access.")
             else:
                 # For downgrades: create prorations but don't invoice until next cycle
                 proration_behavior = 'create_prorations'
-                print(f"This is a downgrade (${current_price} → ${new_price}). Using 'create_prorations' for end-of-cycle change.")
+                logger.debug(f"This is a downgrade (${current_price} → ${new_price}). Using 'create_prorations' for end-of-cycle change.")
             
             # Update the existing subscription item with the new price
-            print("Modifying Stripe subscription...")
+            logger.debug("Modifying Stripe subscription...")
             stripe_subscription = stripe.Subscription.modify(
                 current_subscription.stripe_subscription_id,
                 cancel_at_period_end=False,
@@ -139,44 +223,67 @@ class StripeService:
                 }],
                 default_payment_method=payment_method_id or None
             )
-            print(f"Stripe subscription modified successfully: {stripe_subscription.id}")
+            logger.debug(f"Stripe subscription modified successfully: {stripe_subscription.id}")
             
             # Sync local subscription
-            print("Updating local subscription...")
+            logger.debug("Updating local subscription...")
             Subscription.objects.filter(id=current_subscription.id).update(
                 plan=new_plan,
                 status=stripe_subscription.status,
-                current_period_start=datetime.fromtimestamp(stripe_subscription.get('current_period_start'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_start') else timezone.now(),
-                current_period_end=datetime.fromtimestamp(stripe_subscription.get('current_period_end'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_end') else timezone.now() + timedelta(days=30),
-                trial_start=datetime.fromtimestamp(stripe_subscription.get('trial_start'), tz=dt_timezone.utc) if stripe_subscription.get('trial_start') else None,
-                trial_end=datetime.fromtimestamp(stripe_subscription.get('trial_end'), tz=dt_timezone.utc) if stripe_subscription.get('trial_end') else None,
+                **stripe_subscription_dates(stripe_subscription),
             )
             
             # Optionally sync invoices
-            print("Syncing invoice history...")
+            logger.debug("Syncing invoice history...")
             StripeService.get_invoice_history(current_subscription)
             
-            result = Subscription.objects.get(id=current_subscription.id)
-            print(f"Upgrade completed successfully for subscription {result.id}")
+            # Load the plan with it; the view serializes the result straight away
+            result = Subscription.objects.select_related('plan').get(id=current_subscription.id)
+            logger.info(f"Upgrade completed successfully for subscription {result.id}")
             return result
             
         except stripe.error.StripeError as e:
-            print(f"Stripe error in upgrade: {str(e)}")
+            logger.error(f"Stripe error in upgrade: {str(e)}")
             raise Exception(f"Failed to upgrade subscription: {str(e)}")
         except Exception as e:
-            print(f"General error in upgrade: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"General error in upgrade: {str(e)}")
             raise Exception(f"An error occurred while upgrading subscription: {str(e)}")
 
+    @staticmethod
+    def retrieve_subscription(subscription_id):
+        """Retrieve a Stripe subscription, reusing a recent copy from the cache"""
+        cache_key = STRIPE_SUBSCRIPTION_CACHE_KEY.format(subscription_id=subscription_id)
+        data = cache.get(cache_key)
+        if data is not None:
+            return stripe.Subscription.construct_from(data, stripe.api_key)
+        
+        stripe_subscription = stripe_retry(stripe.Subscription.retrieve)(subscription_id)
+        # Cache plain data only; a pickled StripeObject carries the secret API key into the cache
+        cache.set(cache_key, json.loads(json.dumps(stripe_subscription)), STRIPE_SUBSCRIPTION_CACHE_TTL)
+        return stripe_subscription
+
+    @staticmethod
+    def invalidate_subscription(subscription_id):
+        """Drop the cached copy of a Stripe subscription"""
+        cache.delete(STRIPE_SUBSCRIPTION_CACHE_KEY.format(subscription_id=subscription_id))
+
     @staticmethod
     def get_or_create_customer(user):
         """Get existing customer or create new one"""
         try:
+            # Callers only need the ID, so skip the Stripe round-trip when it is known
+            if user.stripe_customer_id:
+                return stripe.Customer.construct_from({'id': user.stripe_customer_id}, stripe.api_key)
+            
             # Check if user already has a subscription with customer ID
-            existing_subscription = Subscription.objects.filter(user=user).first()
-            if existing_subscription:
-                return stripe.Customer.retrieve(existing_subscription.stripe_customer_id)
+            customer_id = Subscription.objects.filter(user=user).values_list('stripe_customer_id', flat=True).first()
+            if customer_id and not customer_id.startswith('trial_'):
+                # Backfill users created before the customer ID was stored on them
+                User.objects.filter(pk=user.pk, stripe_customer_id__isnull=True).update(stripe_customer_id=customer_id)
+                user.stripe_customer_id = customer_id
+                return stripe.Customer.construct_from({'id': customer_id}, stripe.api_key)
+            if customer_id:
+                return stripe.Customer.retrieve(customer_id)
             
             # Create new customer
             return StripeService.create_customer(user)
@@ -184,6 +291,19 @@ class StripeService:
         except stripe.error.StripeError as e:
             raise Exception(f"Failed to get/create customer: {str(e)}")
 
+    @staticmethod
+    def set_default_payment_method_if_missing(user, customer_id, payment_method_id):
+        """Make a newly attached card the customer's default when the user has no other default"""
+        # The payment_method.attached webhook may already have saved this card as the default
+        if PaymentMethod.objects.filter(user=user, is_default=True).exclude(stripe_payment_method_id=payment_method_id).exists():
+            return False
+        
+        stripe.Customer.modify(
+            customer_id,
+            invoice_settings={'default_payment_method': payment_method_id}
+        )
+        return True
+
     @staticmethod
     def cancel_subscription(subscription, cancel_at_period_end=True):
         """Cancel a subscription"""
@@ -228,33 +348,55 @@ class StripeService:
     def sync_subscription_from_stripe(stripe_subscription_id):
         """Sync subscription data from Stripe"""
         try:
-            stripe_subscription = stripe.Subscription.retrieve(stripe_subscription_id)
-            subscription = Subscription.objects.get(stripe_subscription_id=stripe_subscription_id)
-            
-            subscription.status = stripe_subscription.status
-            subscription.current_period_start = datetime.fromtimestamp(stripe_subscription.get('current_period_start'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_start') else timezone.now()
-            subscription.current_period_end = datetime.fromtimestamp(stripe_subscription.get('current_period_end'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_end') else timezone.now() + timedelta(days=30)
-            subscription.trial_start = datetime.fromtimestamp(stripe_subscription.get('trial_start'), tz=dt_timezone.utc) if stripe_subscription.get('trial_start') else None
-            subscription.trial_end = datetime.fromtimestamp(stripe_subscription.get('trial_end'), tz=dt_timezone.utc) if stripe_subscription.get('trial_end') else None
-            subscription.canceled_at = datetime.fromtimestamp(stripe_subscription.get('canceled_at'), tz=dt_timezone.utc) if stripe_subscription.get('canceled_at') else None
-            subscription.save()
-            
-            return subscription
-            
+            # Syncing needs the live object, so retry instead of reading the cached copy
+            stripe_subscription = stripe_retry(stripe.Subscription.retrieve)(stripe_subscription_id)
+        except TRANSIENT_WEBHOOK_ERRORS:
+            raise
         except stripe.error.StripeError as e:
             raise Exception(f"Failed to sync subscription: {str(e)}")
+        
+        return StripeService.sync_subscription_from_object(stripe_subscription)
+
+    @staticmethod
+    def sync_subscription_from_object(stripe_subscription):
+        """Write a Stripe subscription object the caller already holds to the local row"""
+        with transaction.atomic():
+            # Lock the row so a concurrent subscription webhook waits instead of being overwritten,
+            # and write back only the Stripe-owned columns
+            subscription = Subscription.objects.select_for_update(of=('self',)).get(stripe_subscription_id=stripe_subscription['id'])
+            
+            subscription.status = stripe_subscription['status']
+            for field, value in stripe_subscription_dates(stripe_subscription).items():
+                setattr(subscription, field, value)
+            subscription.canceled_at = stripe_timestamp(stripe_subscription.get('canceled_at'))
+            subscription.save(update_fields=['status', *SUBSCRIPTION_DATE_FIELDS, 'canceled_at', 'updated_at'])
+        
+        return subscription
+
+    @staticmethod
+    def upsert_user_subscription(user, plan, stripe_subscription):
+        """Create the user's one subscription row, or bring an existing one in line with Stripe"""
+        return Subscription.objects.update_or_create(
+            user=user,
+            defaults={
+                'plan': plan,
+                'stripe_subscription_id': stripe_subscription['id'],
+                'stripe_customer_id': stripe_subscription['customer'],
+                'status': stripe_subscription['status'],
+                **stripe_subscription_dates(stripe_subscription),
+            }
+        )
 
     @staticmethod
     def create_payment_method(user, payment_method_id):
         """Create payment method record"""
         try:
-            payment_method = stripe.PaymentMethod.retrieve(payment_method_id)
-            
-            # Attach to customer
+            # Attach to customer; the response carries the card details
             customer = StripeService.get_or_create_customer(user)
-            payment_method.attach(customer=customer.id)
+            payment_method = stripe.PaymentMethod.attach(payment_method_id, customer=customer.id)
             
-            # Create local record
+            # Create local record; one UPDATE demotes the user's other cards
+            PaymentMethod.objects.filter(user=user, is_default=True).update(is_default=False)
             pm = PaymentMethod.objects.create(
                 user=user,
                 stripe_payment_method_id=payment_method_id,
@@ -285,18 +427,19 @@ class StripeService:
                 limit=100
             )
             
-            for invoice_data in invoices.data:
-                Invoice.objects.get_or_create(
+            # One multi-row INSERT; invoices already stored are left untouched
+            Invoice.objects.bulk_create([
+                Invoice(
+                    subscription=subscription,
                     stripe_invoice_id=invoice_data.id,
-                    defaults={
-                        'subscription': subscription,
-                        'amount': invoice_data.amount_paid / 100,  # Convert from cents
-                        'currency': invoice_data.currency,
-                        'status': invoice_data.status,
-                        'invoice_pdf': invoice_data.invoice_pdf,
-                        'hosted_invoice_url': invoice_data.hosted_invoice_url,
-                    }
+                    amount=invoice_data.amount_paid / 100,  # Convert from cents
+                    currency=invoice_data.currency,
+                    status=invoice_data.status,
+                    invoice_pdf=invoice_data.invoice_pdf or '',
+                    hosted_invoice_url=invoice_data.hosted_invoice_url or '',
                 )
+                for invoice_data in invoices.data
+            ], ignore_conflicts=True)
             
             return subscription.invoices.all()
             
@@ -305,9 +448,26 @@ class StripeService:
 
 # Credit System Service
 class CreditService:
+    @staticmethod
+    def get_usage_summary_cache_key(user_id):
+        """Cache key for the user's credit balance summary"""
+        return f"credit_summary:{user_id}"
+    
+    @staticmethod
+    def invalidate_usage_summary(user):
+        """Drop the cached credit summary once the current transaction commits"""
+        cache_key = CreditService.get_usage_summary_cache_key(user.id)
+        transaction.on_commit(lambda: cache.delete(cache_key))
+    
     @staticmethod
     def get_or_create_credit_balance(user):
         """Get or create credit balance for user"""
+        # Reuse the balance already loaded on this user instance (or via select_related)
+        try:
+            return user.credit_balance
+        except UserCreditBalance.DoesNotExist:
+            pass
+        
         balance, created = UserCreditBalance.objects.get_or_create(
             user=user,
             defaults={
@@ -345,6 +505,7 @@ class CreditService:
                 credit_balance.trial_credits_allocated = True
                 credit_balance.save()
             
+            CreditService.invalidate_usage_summary(user)
             logger.info(f"Allocated 500 trial credits for user {user.email}")
             return credit_balance
             
@@ -373,10 +534,8 @@ class CreditService:
     @staticmethod
     def get_trial_model_restrictions():
         """Get model restrictions for trial users"""
-        return {
-            'allowed_models': ['gpt-4o-mini'],
-            'restricted_models': ['gpt-4o', 'claude-3-sonnet', 'claude-3-haiku', 'claude-3-opus', 'gemini-pro', 'gemini-pro-vision']
-        }
+        # A fresh copy, since callers add it to responses and cached summaries
+        return {key: list(model_names) for key, model_names in TRIAL_MODEL_RESTRICTIONS.items()}
     
     @staticmethod
     def get_ai_model(model_name):
@@ -402,6 +561,15 @@ class CreditService:
         """Deduct credits for a request"""
         from .models import CreditUsageLog
         
+        # Clients may send an empty field; store it as NULL so it never collides under the unique constraint
+        request_id = request_id or None
+        
+        # A retried request_id replays the original deduction with one indexed lookup
+        if request_id:
+            prior_result = CreditService.get_prior_deduction(user, request_id)
+            if prior_result:
+                return prior_result
+        
         # Check if user is in trial and validate model restrictions
         if CreditService.is_trial_user(user):
             trial_restrictions = CreditService.get_trial_model_restrictions()
@@ -435,37 +603,96 @@ class CreditService:
             (output_tokens_decimal / Decimal('1000')) * model.cost_per_1k_tokens
         )
         
-        # Deduct credits
-        if not balance.deduct_credits(credits_needed):
-            raise ValueError("Failed to deduct credits")
+        log_fields = {
+            'user_id': user.id,
+            'model_id': model.id,
+            'bot_id': bot_id,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'cost_usd': cost_usd,
+            'credits_deducted': credits_needed,
+            'request_id': request_id
+        }
         
-        # Log the usage
-        usage_log = CreditUsageLog.objects.create(
-            user=user,
-            model=model,
-            bot_id=bot_id,
-            input_tokens=input_tokens,
-            output_tokens=output_tokens,
-            cost_usd=cost_usd,
-            credits_deducted=credits_needed,
-            request_id=request_id
-        )
+        with transaction.atomic():
+            usage_log_id = None
+            if request_id:
+                # Claim the request_id before touching the balance; a concurrent retry
+                # blocks on the unique constraint and then finds this row
+                usage_log, created = CreditUsageLog.objects.get_or_create(
+                    user_id=user.id,
+                    request_id=request_id,
+                    defaults=log_fields
+                )
+                if not created:
+                    return CreditService.get_prior_deduction(user, request_id)
+                usage_log_id = usage_log.id
+            
+            # Deduct credits; fails if a concurrent request drained the balance first
+            if not balance.deduct_credits(credits_needed):
+                raise ValueError(f"Insufficient credits. Required: {credits_needed}, Available: {balance.credits_remaining}")
+            
+            # Keyed requests were logged above; the buffer can't enforce the unique constraint
+            if not request_id:
+                if settings.CREDIT_USAGE_LOG_BUFFERED:
+                    # Inserted in bulk by flush_credit_usage_logs, so there is no log ID yet;
+                    # the row carries the deduction time rather than the flush time
+                    buffered_fields = dict(log_fields, created_at=timezone.now())
+                    transaction.on_commit(lambda: CreditService.buffer_usage_log(buffered_fields))
+                else:
+                    usage_log_id = CreditUsageLog.objects.create(**log_fields).id
         
+        CreditService.invalidate_usage_summary(user)
         logger.info(f"Credits deducted for user {user.email}: {credits_needed} credits for {model_name}")
         
         return {
             'credits_deducted': credits_needed,
             'credits_remaining': balance.credits_remaining,
             'cost_usd': cost_usd,
-            'usage_log_id': usage_log.id
+            'usage_log_id': usage_log_id
         }
     
+    @staticmethod
+    def get_prior_deduction(user, request_id):
+        """Result of an earlier deduction logged under request_id, or None"""
+        from .models import CreditUsageLog
+        
+        usage_log = CreditUsageLog.objects.filter(user=user, request_id=request_id).values(
+            'id', 'credits_deducted', 'cost_usd',
+            credits_remaining=models.F('user__credit_balance__credits_remaining')
+        ).first()
+        if not usage_log:
+            return None
+        
+        logger.info(f"Replaying credit deduction for user {user.id}, request_id {request_id}")
+        return {
+            'credits_deducted': usage_log['credits_deducted'],
+            'credits_remaining': usage_log['credits_remaining'],
+            'cost_usd': usage_log['cost_usd'],
+            'usage_log_id': usage_log['id']
+        }
+    
+    @staticmethod
+    def buffer_usage_log(log_fields):
+        """Queue a usage log row in Redis for the next bulk insert"""
+        from bots.redis_pub import get_redis_client
+        from .models import CreditUsageLog
+        
+        try:
+            get_redis_client().rpush(CREDIT_USAGE_LOG_BUFFER_KEY, json.dumps(log_fields, cls=DjangoJSONEncoder))
+        except Exception as e:
+            # The credits are already deducted, so write the row directly rather than lose it
+            # or fail a request the client would retry and be charged for again
+            logger.error(f"Error buffering credit usage log, inserting it directly: {e}")
+            CreditUsageLog.objects.create(**log_fields)
+    
     @staticmethod
     def add_credits(user, credits_to_add, reason=None):
         """Add credits to user balance (admin function)"""
         balance = CreditService.get_or_create_credit_balance(user)
         
         if balance.add_credits(credits_to_add):
+            CreditService.invalidate_usage_summary(user)
             logger.info(f"Credits added for user {user.email}: {credits_to_add} credits. Reason: {reason}")
             return True
         return False
@@ -510,6 +737,7 @@ class CreditService:
         balance.credits_used_this_period = 0
         balance.credits_reset_date = subscription.current_period_end
         balance.save()
+        CreditService.invalidate_usage_summary(user)
         
         logger.info(f"Credits reset for user {user.email}: {credits_allocation} credits")
         return balance
@@ -526,8 +754,8 @@ class CreditService:
                 return False
             
             # Check if the invoice period matches the subscription's current period
-            invoice_period_start = datetime.fromtimestamp(invoice_data.get('period_start', 0), tz=dt_timezone.utc)
-            invoice_period_end = datetime.fromtimestamp(invoice_data.get('period_end', 0), tz=dt_timezone.utc)
+            invoice_period_start = stripe_timestamp(invoice_data.get('period_start'))
+            invoice_period_end = stripe_timestamp(invoice_data.get('period_end'))
             
             # If invoice period matches subscription period, it's a renewal
             if (invoice_period_start == subscription.current_period_start and 
@@ -565,6 +793,7 @@ class CreditService:
                 credit_balance.is_trial_user = False
                 credit_balance.trial_credits_allocated = False
                 credit_balance.save()
+                CreditService.invalidate_usage_summary(user)
                 
                 logger.info(f"Allocated {credits_to_allocate} credits for user {user.email} on plan {subscription.plan.name}")
             else:
@@ -588,6 +817,7 @@ class CreditService:
                 balance.is_trial_user = False
                 balance.trial_credits_allocated = False
                 balance.save()
+                CreditService.invalidate_usage_summary(user)
                 
                 logger.info(f"Fresh credit allocation for trial user {user.email} upgrading to {new_plan.name}: {credits_to_allocate} credits")
                 return balance
@@ -619,6 +849,7 @@ class CreditService:
             balance.credits_remaining = credits_to_allocate
             balance.credits_reset_date = subscription.current_period_end
             balance.save()
+            CreditService.invalidate_usage_summary(user)
             
             logger.info(f"Prorated credits for user {user.email} upgrading from {old_plan.name} to {new_plan.name}: {credits_to_allocate} credits")
             return balance
@@ -653,10 +884,492 @@ class CreditService:
                 balance.is_trial_user = False
                 balance.trial_credits_allocated = False
                 balance.save()
+                CreditService.invalidate_usage_summary(user)
                 
                 logger.info(f"Allocated {credits_to_allocate} credits for user {user.email} upgrading to {new_plan.name}")
                 return balance
             
         except Exception as e:
             logger.error(f"Error allocating credits for plan change for user {user.email}: {e}")
-            raise 
\ No newline at end of file
+            raise 
+
+class WebhookService:
+    # Stripe event type -> handler method name
+    HANDLERS = {
+        'customer.subscription.created': 'handle_subscription_created',
+        'customer.subscription.updated': 'handle_subscription_updated',
+        'customer.subscription.deleted': 'handle_subscription_deleted',
+        'invoice.payment_succeeded': 'handle_payment_succeeded',
+        'invoice.payment_failed': 'handle_payment_failed',
+        'checkout.session.completed': 'handle_checkout_completed',
+        'invoice.created': 'handle_invoice_created',
+        'payment_method.attached': 'handle_payment_method_attached',
+    }
+
+    @staticmethod
+    def handle_event(event_type, event_data):
+        """Route a Stripe webhook event to its handler"""
+        handler_name = WebhookService.HANDLERS.get(event_type)
+        if not handler_name:
+            return
+        
+        # Stripe just reported a change, so the next read must not see the cached copy
+        if event_type.startswith('customer.subscription.'):
+            StripeService.invalidate_subscription(event_data['id'])
+        elif event_type.startswith('invoice.') and event_data.get('subscription'):
+            subscription_id = event_data['subscription']
+            # An expanded invoice carries the subscription object rather than its ID
+            if isinstance(subscription_id, dict):
+                subscription_id = subscription_id['id']
+            StripeService.invalidate_subscription(subscription_id)
+        
+        getattr(WebhookService, handler_name)(event_data)
+    
+    @staticmethod
+    def get_plans_by_price():
+        """Every plan keyed by Stripe price ID, cached until a plan changes"""
+        return cache.get_or_set(
+            SUBSCRIPTION_PLANS_BY_PRICE_CACHE_KEY,
+            lambda: {plan.stripe_price_id: plan for plan in SubscriptionPlan.objects.all()},
+            SUBSCRIPTION_PLANS_CACHE_TTL
+        )
+    
+    @staticmethod
+    def get_plan_for_price(price_id):
+        """Plan billed at a Stripe price, or None; served from a cached map so bursts skip the query"""
+        return WebhookService.get_plans_by_price().get(price_id)
+    
+    @staticmethod
+    def get_plan_by_id(plan_id):
+        """Plan named in Stripe metadata, or None; a scan of the same cached map, which holds a handful of plans"""
+        return next((plan for plan in WebhookService.get_plans_by_price().values() if str(plan.id) == str(plan_id)), None)
+    
+    @staticmethod
+    def get_user_for_customer(customer_id, customer=None):
+        """User owning a Stripe customer; only asks Stripe for the email when the ID isn't stored locally"""
+        user = User.objects.filter(stripe_customer_id=customer_id).first()
+        if user:
+            return user
+        subscription = Subscription.objects.select_related('user').filter(stripe_customer_id=customer_id).first()
+        if subscription:
+            user = subscription.user
+        else:
+            if customer is None:
+                customer = stripe_retry(stripe.Customer.retrieve)(customer_id)
+            # Expanded customers in webhook payloads arrive as plain dicts from the Celery task
+            email = customer.get('email')
+            if not email:
+                raise User.DoesNotExist(f"No email found for customer {customer_id}")
+            user = User.objects.get(email=email)
+        # Link the customer so the next webhook for it is resolved locally
+        User.objects.filter(pk=user.pk, stripe_customer_id__isnull=True).update(stripe_customer_id=customer_id)
+        return user
+    
+    @staticmethod
+    def get_or_create_local_subscription(subscription_id, stripe_subscription=None):
+        """Local row for a Stripe subscription, created from Stripe data when a webhook beats it here.
+        
+        Returns the row (None if it can't be resolved) and any Stripe subscription object fetched on the way.
+        """
+        try:
+            subscription = Subscription.objects.select_related('user', 'plan').get(stripe_subscription_id=subscription_id)
+            logger.info(f"Found subscription: {subscription.id} for user: {subscription.user.email}")
+            return subscription, stripe_subscription
+        except Subscription.DoesNotExist:
+            logger.info(f"No subscription found for ID: {subscription_id}")
+        
+        try:
+            if stripe_subscription is None:
+                # Expand the customer so one Stripe round-trip returns both objects
+                stripe_subscription = stripe_retry(stripe.Subscription.retrieve)(subscription_id, expand=['customer'])
+            customer = stripe_subscription['customer']
+            customer_id = customer if isinstance(customer, str) else customer['id']
+            
+            try:
+                user = WebhookService.get_user_for_customer(customer_id, None if isinstance(customer, str) else customer)
+            except TRANSIENT_WEBHOOK_ERRORS:
+                raise
+            except Exception as e:
+                logger.error(f"Error finding user for customer {customer_id}: {e}")
+                return None, stripe_subscription
+            
+            # Get plan from price ID
+            plan = None
+            if stripe_subscription.get('items') and stripe_subscription['items'].get('data'):
+                price_id = stripe_subscription['items']['data'][0]['price']['id']
+                plan = WebhookService.get_plan_for_price(price_id)
+                if not plan:
+                    logger.error(f"Plan with price {price_id} not found")
+                    return None, stripe_subscription
+            
+            # Create subscription from Stripe data
+            subscription, created = Subscription.objects.get_or_create(
+                stripe_subscription_id=stripe_subscription['id'],
+                defaults={
+                    'user': user,
+                    'plan': plan,
+                    'stripe_customer_id': customer_id,
+                    'status': stripe_subscription['status'],
+                    **stripe_subscription_dates(stripe_subscription),
+                }
+            )
+            if created:
+                logger.info(f"Created subscription {subscription.id} from Stripe data")
+            else:
+                logger.info(f"Subscription {subscription.id} already exists from Stripe data")
+            return subscription, stripe_subscription
+        except TRANSIENT_WEBHOOK_ERRORS:
+            raise
+        except Exception as e:
+            logger.error(f"Error getting subscription from Stripe: {str(e)}")
+            return None, stripe_subscription
+    
+    @staticmethod
+    def handle_subscription_created(subscription_data):
+        """Handle subscription.created webhook"""
+        try:
+            user_id = subscription_data.get('metadata', {}).get('user_id')
+            if not user_id:
+                logger.error("No user_id in subscription metadata")
+                return
+            
+            # Get plan from metadata or find by price ID
+            plan_id = subscription_data.get('metadata', {}).get('plan_id')
+            plan = None
+            if plan_id:
+                plan = WebhookService.get_plan_by_id(plan_id)
+                if not plan:
+                    logger.error(f"Plan {plan_id} not found")
+            
+            if not plan:
+                # Try to find plan by price ID
+                price_id = subscription_data['items']['data'][0]['price']['id']
+                plan = WebhookService.get_plan_for_price(price_id)
+                if not plan:
+                    logger.error(f"Plan with price ID {price_id} not found")
+            
+            with transaction.atomic():
+                # Lock the user so a concurrent delivery (or checkout.session.completed)
+                # waits here instead of racing us to create the subscription
+                try:
+                    user = User.objects.select_for_update().get(id=user_id)
+                except User.DoesNotExist:
+                    logger.error(f"User {user_id} not found")
+                    return
+                
+                # Check if subscription already exists
+                if Subscription.objects.filter(stripe_subscription_id=subscription_data['id']).exists():
+                    logger.info(f"Subscription {subscription_data['id']} already exists")
+                    return
+                
+                # Create subscription record
+                subscription, created = StripeService.upsert_user_subscription(user, plan, subscription_data)
+                
+                # Allocate credits for new subscription
+                CreditService.allocate_credits_for_new_subscription(user, subscription)
+            
+            logger.info(f"Subscription created for user {user.email}")
+            
+        except TRANSIENT_WEBHOOK_ERRORS:
+            raise
+        except Exception as e:
+            logger.exception(f"Error handling subscription.created: {e}")
+    
+    @staticmethod
+    def handle_subscription_updated(subscription_data):
+        """Handle subscription.updated webhook"""
+        try:
+            with transaction.atomic():
+                subscription = Subscription.objects.select_for_update(of=('self',)).annotate(user_email=models.F('user__email')).get(stripe_subscription_id=subscription_data['id'])
+                old_status = subscription.status
+                subscription.status = subscription_data['status']
+                # Stripe may omit the period on some updates; keep the stored values then
+                subscription.current_period_start = stripe_timestamp(subscription_data.get('current_period_start')) or subscription.current_period_start
+                subscription.current_period_end = stripe_timestamp(subscription_data.get('current_period_end')) or subscription.current_period_end
+                subscription.save()
+            
+            # Only reset credits if this is a new billing cycle AND payment succeeded
+            # Don't reset credits just because status changed to active
+            # Credits should only reset when payment succeeds for the new billing cycle
+            if old_status != 'active' and subscription.status == 'active':
+                # This might be a new subscription, not a billing cycle renewal
+                # We'll handle credit reset in payment_succeeded webhook instead
+                pass
+            
+            logger.info(f"Subscription updated for user {subscription.user_email}")
+        except Subscription.DoesNotExist:
+            logger.error(f"Subscription {subscription_data['id']} not found")
+        except TRANSIENT_WEBHOOK_ERRORS:
+            raise
+        except Exception as e:
+            logger.exception(f"Error handling subscription.updated: {e}")
+    
+    @staticmethod
+    def handle_subscription_deleted(subscription_data):
+        """Handle subscription.deleted webhook"""
+        try:
+            with transaction.atomic():
+                # Only the columns being written are loaded, and only they are saved back
+                subscription = Subscription.objects.select_for_update(of=('self',)).annotate(
+                    user_email=models.F('user__email')
+                ).only('id', 'status', 'canceled_at').get(stripe_subscription_id=subscription_data['id'])
+                subscription.status = 'canceled'
+                subscription.canceled_at = timezone.now()
+                subscription.save(update_fields=['status', 'canceled_at', 'updated_at'])
+            
+            logger.info(f"Subscription canceled for user {subscription.user_email}")
+        except Subscription.DoesNotExist:
+            logger.error(f"Subscription {subscription_data['id']} not found")
+        except TRANSIENT_WEBHOOK_ERRORS:
+            raise
+        except Exception as e:
+            logger.exception(f"Error handling subscription.deleted: {e}")
+    
+    @staticmethod
+    def handle_payment_succeeded(invoice_data):
+        """Handle invoice.payment_succeeded webhook"""
+        try:
+            subscription_id = invoice_data.get('subscription')
+            if not subscription_id:
+                logger.info("No subscription found for invoice")
+                return
+            
+            # An expanded invoice already carries the subscription object, so the sync can skip Stripe
+            stripe_subscription = None
+            if isinstance(subscription_id, dict):
+                stripe_subscription = subscription_id
+                subscription_id = stripe_subscription['id']
+            
+            # Get subscription from database or create from Stripe
+            subscription, stripe_subscription = WebhookService.get_or_create_local_subscription(subscription_id, stripe_subscription)
+            if subscription is None:
+                return
+            
+            with transaction.atomic():
+                # Create or update invoice
+                invoice, created = Invoice.objects.update_or_create(
+                    stripe_invoice_id=invoice_data['id'],
+                    defaults={
+                        'subscription': subscription,
+                        'amount': (invoice_data.get('amount_paid') or invoice_data.get('amount_due') or 0) / 100,
+                        'currency': invoice_data.get('currency', 'usd'),
+                        'status': invoice_data.get('status', 'paid'),
+                        # Stripe sends null rather than omitting these; the columns are NOT NULL
+                        'invoice_pdf': invoice_data.get('invoice_pdf') or '',
+                        'hosted_invoice_url': invoice_data.get('hosted_invoice_url') or '',
+                    }
+                )
+                if created:
+                    logger.info(f"Created new invoice {invoice.id} for subscription {subscription.id}")
+                else:
+                    logger.info(f"Updated existing invoice {invoice.id}")
+                
+                # Only reset credits if this is a billing cycle renewal, not a new subscription
+                if CreditService.is_billing_cycle_renewal(subscription, invoice_data):
+                    CreditService.reset_credits_for_billing_cycle(subscription.user, subscription)
+                    logger.info(f"Credits reset for billing cycle renewal - user {subscription.user.email}")
+                else:
+                    logger.info(f"Payment succeeded for new subscription - user {subscription.user.email}")
+                
+                # A rolled-back payment must not email the customer
+                transaction.on_commit(lambda: WebhookService.queue_payment_success_email(subscription, invoice))
+            
+            # Sync subscription status outside the transaction, reusing any subscription object fetched above
+            if stripe_subscription is not None:
+                StripeService.sync_subscription_from_object(stripe_subscription)
+            else:
+                try:
+                    StripeService.sync_subscription_from_stripe(subscription_id)
+                except TRANSIENT_WEBHOOK_ERRORS as e:
+                    # The invoice and credits are committed; retrying the whole event would
+                    # email the customer again, so only the sync is tried later
+                    from .tasks import sync_subscription
+                    logger.warning(f"Deferring sync of subscription {subscription_id}: {e}")
+                    sync_subscription.delay(subscription_id)
+            
+            logger.info(f"Payment succeeded for user {subscription.user.email}")
+            
+        except Subscription.DoesNotExist:
+            logger.error(f"Subscription {invoice_data['subscription']} not found - this may be normal for new subscriptions")
+        except TRANSIENT_WEBHOOK_ERRORS:
+            raise
+        except Exception as e:
+            logger.exception(f"Error handling payment.succeeded: {e}")
+    
+    @staticmethod
+    def queue_payment_success_email(subscription, invoice):
+        """Send payment success email from its own task so delivery never holds up the webhook"""
+        from .tasks import send_payment_success_notification
+        try:
+            send_payment_success_notification.delay(
+                subscription.id,
+                str(invoice.amount),
+                invoice.stripe_invoice_id,
+                invoice.hosted_invoice_url
+            )
+        except Exception as e:
+            logger.error(f"Error queueing payment success email for {subscription.user.email}: {str(e)}")
+    
+    @staticmethod
+    def handle_payment_failed(invoice_data):
+        """Handle invoice.payment_failed webhook"""
+        try:
+            # The email task loads its own rows; here only the ID and address for logging are needed
+            subscription_id, user_email = Subscription.objects.values_list('id', 'user__email').get(
+                stripe_subscription_id=invoice_data['subscription']
+            )
+            
+            # Send payment failed email from its own task so delivery never holds up the webhook
+            from .tasks import send_payment_failed_notification
+            try:
+                send_payment_failed_notification.delay(subscription_id)
+            except Exception as e:
+                logger.error(f"Error queueing payment failed email for {user_email}: {str(e)}")
+            
+            logger.info(f"Payment failed for user {user_email}")
+            
+        except Subscription.DoesNotExist:
+            logger.error(f"Subscription {invoice_data['subscription']} not found")
+        except TRANSIENT_WEBHOOK_ERRORS:
+            raise
+        except Exception as e:
+            logger.exception(f"Error handling payment.failed: {e}")
+    
+    @staticmethod
+    def handle_checkout_completed(session_data):
+        """Handle checkout.session.completed webhook"""
+        try:
+            user_id = session_data.get('metadata', {}).get('user_id')
+            plan_id = session_data.get('metadata', {}).get('plan_id')
+            is_trial_upgrade = session_data.get('metadata', {}).get('is_trial_upgrade') == 'true'
+            
+            if not user_id or not plan_id:
+                logger.error("Missing user_id or plan_id in checkout session metadata")
+                return
+            
+            plan = WebhookService.get_plan_by_id(plan_id)
+            if not plan:
+                logger.error(f"Plan {plan_id} not found")
+                return
+            try:
+                user = User.objects.get(id=user_id)
+            except User.DoesNotExist:
+                logger.error(f"User {user_id} not found")
+                return
+            
+            subscription_id = session_data.get('subscription')
+            if subscription_id:
+                # subscription.created usually lands first and has already written Stripe's data;
+                # only a checkout that beats it needs the subscription from Stripe
+                stripe_subscription = None
+                if not Subscription.objects.filter(user=user, stripe_subscription_id=subscription_id).exists():
+                    try:
+                        stripe_subscription = StripeService.retrieve_subscription(subscription_id)
+                    except stripe.error.InvalidRequestError as e:
+                        logger.error(f"Subscription {subscription_id} not found in Stripe: {str(e)}")
+                        return
+                    except TRANSIENT_WEBHOOK_ERRORS:
+                        raise
+                    except Exception as e:
+                        logger.exception(f"Error retrieving subscription from Stripe: {str(e)}")
+                        return
+                
+                with transaction.atomic():
+                    # Lock the user so a concurrent subscription.created for the same
+                    # checkout waits here instead of racing us to create the row
+                    user = User.objects.select_for_update().get(pk=user.pk)
+                    
+                    if stripe_subscription is None:
+                        subscription = Subscription.objects.get(user=user, stripe_subscription_id=subscription_id)
+                        created = False
+                        plan_changed = subscription.plan_id != plan.id
+                        subscription.plan = plan
+                        if plan_changed:
+                            subscription.save(update_fields=['plan', 'updated_at'])
+                    else:
+                        subscription, created = StripeService.upsert_user_subscription(user, plan, stripe_subscription)
+                    
+                    if created:
+                        logger.info(f"Created new subscription {subscription.id} for user {user.email}")
+                    else:
+                        logger.info(f"Updated subscription {subscription.id} for user {user.email}")
+                    
+                    # Allocate credits for the subscription
+                    CreditService.allocate_credits_for_new_subscription(user, subscription)
+                
+                logger.info(f"Updated existing subscription for user {user.email}")
+                return
+                
+        except TRANSIENT_WEBHOOK_ERRORS:
+            raise
+        except Exception as e:
+            logger.exception(f"Error handling checkout.session.completed: {e}")
+            return
+
+    @staticmethod
+    def handle_invoice_created(invoice_data):
+        """Handle invoice.created webhook"""
+        try:
+            subscription = Subscription.objects.annotate(user_email=models.F('user__email')).get(stripe_subscription_id=invoice_data['subscription'])
+            
+            # Create invoice record in one statement; a retried event or a payment_succeeded that
+            # got here first already holds the row, and its state is at least as fresh as this one
+            Invoice.objects.bulk_create([Invoice(
+                subscription=subscription,
+                stripe_invoice_id=invoice_data['id'],
+                amount=invoice_data['amount_due'] / 100,  # Convert from cents
+                currency=invoice_data['currency'],
+                status=invoice_data['status'],
+                invoice_pdf=invoice_data.get('invoice_pdf') or '',
+                hosted_invoice_url=invoice_data.get('hosted_invoice_url') or ''
+            )], ignore_conflicts=True)
+            
+            logger.info(f"Invoice created for user {subscription.user_email}")
+            
+        except Subscription.DoesNotExist:
+            logger.error(f"Subscription {invoice_data['subscription']} not found")
+        except TRANSIENT_WEBHOOK_ERRORS:
+            raise
+        except Exception as e:
+            logger.exception(f"Error handling invoice.created: {e}")
+
+    @staticmethod
+    def handle_payment_method_attached(payment_method_data):
+        """Handle payment_method.attached webhook"""
+        try:
+            customer_id = payment_method_data['customer']
+            payment_method_id = payment_method_data['id']
+            
+            # Find user by the customer ID stored on them; Stripe is only asked when it isn't
+            try:
+                user = WebhookService.get_user_for_customer(customer_id)
+            except TRANSIENT_WEBHOOK_ERRORS:
+                raise
+            except (User.DoesNotExist, stripe.error.StripeError) as e:
+                logger.error(f"Could not find user for customer {customer_id}: {e}")
+                return
+            
+            # The card may already be saved by CreatePaymentMethodView or a replayed event;
+            # the unique stripe_payment_method_id makes that a lookup instead of an error.
+            # Attaching a card doesn't change the default, so it only becomes one for a user without any
+            payment_method, created = PaymentMethod.objects.get_or_create(
+                stripe_payment_method_id=payment_method_id,
+                defaults={
+                    'user': user,
+                    'card_brand': payment_method_data['card']['brand'],
+                    'card_last4': payment_method_data['card']['last4'],
+                    'card_exp_month': payment_method_data['card']['exp_month'],
+                    'card_exp_year': payment_method_data['card']['exp_year'],
+                    'is_default': not PaymentMethod.objects.filter(user=user, is_default=True).exists()
+                }
+            )
+            if not created:
+                logger.info(f"Payment method {payment_method_id} already saved for user {user.email}")
+                return
+            
+            logger.info(f"Payment method attached for user {user.email}")
+            
+        except TRANSIENT_WEBHOOK_ERRORS:
+            raise
+        except Exception as e:
+            logger.exception(f"Error handling payment_method.attached: {e}")
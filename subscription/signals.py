@@ -1,7 +1,12 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
-from .services import CreditService
+from django.core.cache import cache
+from .models import SubscriptionPlan
+from .services import CreditService, SUBSCRIPTION_PLANS_CACHE_KEY, SUBSCRIPTION_PLANS_BY_PRICE_CACHE_KEY
+import logging
+
+logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
@@ -13,4 +18,9 @@ def allocate_trial_credits_for_new_user(sender, instance, created, **kwargs):
             # Allocate trial credits for new user
             CreditService.allocate_trial_credits(instance)
         except Exception as e:
-            print(f"Error allocating trial credits for user {instance.email}: {e}") 
\ No newline at end of file
+            logger.error(f"Error allocating trial credits for user {instance.email}: {e}")
+
+@receiver([post_save, post_delete], sender=SubscriptionPlan)
+def invalidate_subscription_plans_cache(sender, **kwargs):
+    """Drop the cached plan list and price map whenever a plan changes"""
+    cache.delete_many([SUBSCRIPTION_PLANS_CACHE_KEY, SUBSCRIPTION_PLANS_BY_PRICE_CACHE_KEY])
@@ -2,9 +2,11 @@ from celery import shared_task
 from django.utils import timezone
 from datetime import timedelta
 from django.conf import settings
+from django.db import OperationalError, transaction
 from .models import Subscription
-from .services import StripeService
+from .services import StripeService, WebhookService, CREDIT_USAGE_LOG_BUFFER_KEY, CREDIT_USAGE_LOG_DEAD_LETTER_KEY, TRANSIENT_WEBHOOK_ERRORS
 from email_templates.email_service import EmailService
+import json
 import logging
 
 logger = logging.getLogger(__name__)
@@ -57,6 +59,15 @@ def sync_subscription_status():
     except Exception as e:
         logger.error(f"Error in sync_subscription_status task: {str(e)}")
 
+@shared_task
+def sync_subscription(stripe_subscription_id):
+    """Sync a single subscription with Stripe"""
+    try:
+        StripeService.sync_subscription_from_stripe(stripe_subscription_id)
+        logger.info(f"Synced subscription: {stripe_subscription_id}")
+    except Exception as e:
+        logger.error(f"Error syncing subscription {stripe_subscription_id}: {str(e)}")
+
 @shared_task
 def send_subscription_expired_notification(subscription_id):
     """Send notification to user about expired subscription"""
@@ -84,9 +95,10 @@ def send_subscription_expired_notification(subscription_id):
 def send_trial_ending_notification(subscription_id):
     """Send notification to user about trial ending soon"""
     try:
-        subscription = Subscription.objects.get(id=subscription_id)
+        subscription = Subscription.objects.select_related('user', 'plan').get(id=subscription_id)
         
         # Send email using MailerSend
+        email_service = EmailService()
         if email_service:
             try:
                 success = email_service.send_trial_ending_email(subscription)
@@ -106,9 +118,10 @@ def send_trial_ending_notification(subscription_id):
 def send_payment_failed_notification(subscription_id, retry_date=None):
     """Send notification to user about failed payment"""
     try:
-        subscription = Subscription.objects.get(id=subscription_id)
+        subscription = Subscription.objects.select_related('user', 'plan').get(id=subscription_id)
         
         # Send email using MailerSend
+        email_service = EmailService()
         if email_service:
             try:
                 success = email_service.send_payment_failed_email(subscription, retry_date)
@@ -125,15 +138,16 @@ def send_payment_failed_notification(subscription_id, retry_date=None):
         logger.error(f"Error sending payment failed notification: {str(e)}")
 
 @shared_task
-def send_payment_success_notification(subscription_id, amount, transaction_id):
+def send_payment_success_notification(subscription_id, amount, transaction_id, hosted_invoice_url=None):
     """Send notification to user about successful payment"""
     try:
-        subscription = Subscription.objects.get(id=subscription_id)
+        subscription = Subscription.objects.select_related('user', 'plan').get(id=subscription_id)
         
         # Send email using MailerSend
+        email_service = EmailService()
         if email_service:
             try:
-                success = email_service.send_payment_success_email(subscription, amount, transaction_id)
+                success = email_service.send_payment_success_email(subscription, amount, transaction_id, hosted_invoice_url)
                 if success:
                     logger.info(f"Payment success email sent successfully to {subscription.user.email}")
                 else:
@@ -193,10 +207,8 @@ def cleanup_old_webhook_events():
         
         # Delete webhook events older than 90 days
         cutoff_date = timezone.now() - timedelta(days=90)
-        old_events = WebhookEvent.objects.filter(processed_at__lt=cutoff_date)
-        
-        count = old_events.count()
-        old_events.delete()
+        # A single DELETE; the rows (and their payloads) are never loaded
+        count, _ = WebhookEvent.objects.filter(processed_at__lt=cutoff_date).delete()
         
         logger.info(f"Cleaned up {count} old webhook events")
         
@@ -224,4 +236,75 @@ def send_trial_expiry_reminders():
         logger.info(f"Sent {trial_subscriptions.count()} trial expiry reminders")
         
     except Exception as e:
-        logger.error(f"Error in send_trial_expiry_reminders task: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error in send_trial_expiry_reminders task: {str(e)}")
+
+def insert_credit_usage_logs_individually(client, rows):
+    """Insert buffered usage log rows one at a time, dead-lettering those that fail"""
+    from .models import CreditUsageLog
+    
+    inserted = 0
+    for index, row in enumerate(rows):
+        try:
+            with transaction.atomic():
+                CreditUsageLog.objects.create(**json.loads(row))
+            inserted += 1
+        except OperationalError:
+            # Database went away mid-batch; requeue what is left for the next run
+            client.lpush(CREDIT_USAGE_LOG_BUFFER_KEY, *reversed(rows[index:]))
+            raise
+        except Exception as e:
+            logger.error(f"Dead-lettering credit usage log row: {str(e)}")
+            client.rpush(CREDIT_USAGE_LOG_DEAD_LETTER_KEY, row)
+    return inserted
+
+@shared_task
+def flush_credit_usage_logs(batch_size=500):
+    """Bulk-insert credit usage log rows buffered by CreditService.deduct_credits"""
+    try:
+        from bots.redis_pub import get_redis_client
+        from .models import CreditUsageLog
+        
+        client = get_redis_client()
+        flushed = 0
+        
+        while True:
+            # Take one batch off the list atomically so concurrent flushes never share rows
+            pipe = client.pipeline()
+            pipe.lrange(CREDIT_USAGE_LOG_BUFFER_KEY, 0, batch_size - 1)
+            pipe.ltrim(CREDIT_USAGE_LOG_BUFFER_KEY, batch_size, -1)
+            rows, _ = pipe.execute()
+            if not rows:
+                break
+            
+            try:
+                with transaction.atomic():
+                    CreditUsageLog.objects.bulk_create(
+                        [CreditUsageLog(**json.loads(row)) for row in rows],
+                        batch_size=batch_size
+                    )
+                flushed += len(rows)
+            except OperationalError:
+                # Database unavailable; put the batch back so the next run retries it
+                client.lpush(CREDIT_USAGE_LOG_BUFFER_KEY, *reversed(rows))
+                raise
+            except Exception as e:
+                # One bad row fails the whole INSERT; retry row by row so only that row is set aside
+                logger.warning(f"Bulk insert of {len(rows)} credit usage logs failed, inserting individually: {str(e)}")
+                flushed += insert_credit_usage_logs_individually(client, rows)
+            
+            if len(rows) < batch_size:
+                break
+        
+        if flushed:
+            logger.info(f"Flushed {flushed} buffered credit usage logs")
+        
+    except Exception as e:
+        logger.error(f"Error in flush_credit_usage_logs task: {str(e)}")
+
+# Only transient failures are worth retrying; anything else would fail the same way again.
+# Acked after the handler returns, so an event claimed by the view survives a worker crash
+@shared_task(bind=True, acks_late=True, autoretry_for=TRANSIENT_WEBHOOK_ERRORS, retry_backoff=True, max_retries=5)
+def handle_stripe_event(self, event_id, event_type, event_data):
+    """Process a Stripe webhook event claimed by StripeWebhookView"""
+    WebhookService.handle_event(event_type, event_data)
+    logger.info(f"Processed Stripe webhook {event_type} ({event_id})")
@@ -1,3 +1,977 @@
-from django.test import TestCase
+import json
+import redis
+import stripe
+from decimal import Decimal
+from unittest.mock import Mock, patch
+from django.db import OperationalError
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import timedelta
+from django.urls import reverse
+from django.contrib.auth import get_user_model
+from rest_framework.test import APITestCase
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from .models import AIModel, CreditUsageLog, Invoice, PaymentMethod, Subscription, SubscriptionPlan, UserCreditBalance, WebhookEvent
+from .serializers import CreditUsageLogSerializer
+from .services import CREDIT_USAGE_LOG_DEAD_LETTER_KEY, CreditService, StripeService, WebhookService, stripe_retry
+from .tasks import cleanup_old_webhook_events, flush_credit_usage_logs, handle_stripe_event
+from .views import STRIPE_WEBHOOK_MAX_BYTES
 
-# Create your tests here.
+User = get_user_model()
+
+class CreditBalanceTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            full_name='Test User'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_credit_balance(self):
+        url = reverse('subscription:credit-balance')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['credits_remaining'], 500)
+        self.assertTrue(response.data['is_trial_user'])
+        self.assertEqual(response.data['trial_restrictions']['allowed_models'], ['gpt-4o-mini'])
+
+    def test_credit_balance_is_cached(self):
+        url = reverse('subscription:credit-balance')
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.data['credits_remaining'], 500)
+
+    def test_add_credits_invalidates_cached_balance(self):
+        url = reverse('subscription:credit-balance')
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            CreditService.add_credits(self.user, 100, 'Test')
+        response = self.client.get(url)
+        self.assertEqual(response.data['credits_remaining'], 600)
+
+    @patch('subscription.views.CreditService.get_usage_summary', side_effect=RuntimeError('boom'))
+    def test_unexpected_error_uses_billing_exception_handler(self, mock_summary):
+        url = reverse('subscription:credit-balance')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(response.data, {'error': 'Internal server error'})
+
+class CreditUsageLogTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            full_name='Test User'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.model = AIModel.objects.create(
+            name='gpt-4o-mini',
+            provider='openai',
+            display_name='GPT-4o Mini',
+            cost_per_1k_tokens=Decimal('0.000150'),
+            credit_conversion_rate=Decimal('1.000000')
+        )
+        for i in range(3):
+            CreditUsageLog.objects.create(
+                user=self.user,
+                model=self.model,
+                input_tokens=100,
+                output_tokens=50,
+                cost_usd=Decimal('0.000023'),
+                credits_deducted=Decimal('0.011250'),
+                request_id=f'req-{i}'
+            )
+
+    def test_credit_usage_logs(self):
+        url = reverse('subscription:credit-usage-logs')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual(response.data[0]['model_name'], 'GPT-4o Mini')
+        self.assertEqual(response.data[0]['model_provider'], 'openai')
+
+    def test_credit_usage_logs_match_serializer(self):
+        url = reverse('subscription:credit-usage-logs')
+        response = self.client.get(url)
+        logs = CreditUsageLog.objects.filter(user=self.user).order_by('-created_at')
+        expected = CreditUsageLogSerializer(logs, many=True).data
+        self.assertEqual(response.json(), json.loads(JSONRenderer().render(expected)))
+
+    @patch('subscription.views.CREDIT_USAGE_LOG_PAGE_SIZE', 2)
+    def test_credit_usage_logs_are_paginated_when_page_requested(self):
+        url = reverse('subscription:credit-usage-logs')
+        response = self.client.get(url, {'page': 1})
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNotNone(response.data['next'])
+        response = self.client.get(url, {'page': 2})
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_admin_credit_usage_streams_logs(self):
+        self.user.is_staff = True
+        self.user.save()
+        url = reverse('subscription:admin-credit-usage')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['user'], self.user.id)
+        self.assertEqual(rows[0]['cost_usd'], '0.000023')
+
+    def test_admin_credit_usage_paginates_when_page_requested(self):
+        self.user.is_staff = True
+        self.user.save()
+        url = reverse('subscription:admin-credit-usage')
+        response = self.client.get(url, {'page': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertEqual(response.data['results'][0]['cost_usd'], '0.000023')
+
+    def test_admin_credit_usage_aggregate(self):
+        self.user.is_staff = True
+        self.user.save()
+        url = reverse('subscription:admin-credit-usage')
+        response = self.client.get(url, {'aggregate': '1'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['model_name'], 'gpt-4o-mini')
+        self.assertEqual(response.data[0]['calls'], 3)
+        self.assertEqual(response.data[0]['total_input_tokens'], 300)
+
+class CreditDeductionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            full_name='Test User'
+        )
+        self.model = AIModel.objects.create(
+            name='gpt-4o-mini',
+            provider='openai',
+            display_name='GPT-4o Mini',
+            cost_per_1k_tokens=Decimal('0.002000'),
+            credit_conversion_rate=Decimal('1.000000')
+        )
+
+    def test_deduct_credits(self):
+        result = CreditService.deduct_credits(self.user, 'gpt-4o-mini', 1000, 500, request_id='req-1')
+        self.assertEqual(result['credits_deducted'], Decimal('1.5'))
+        self.assertEqual(result['credits_remaining'], 498)
+        balance = UserCreditBalance.objects.get(user=self.user)
+        self.assertEqual(balance.credits_remaining, 498)
+        self.assertEqual(balance.credits_used_this_period, 1)
+        self.assertEqual(CreditUsageLog.objects.filter(user=self.user).count(), 1)
+
+    def test_deduct_credits_insufficient_balance(self):
+        UserCreditBalance.objects.filter(user=self.user).update(credits_remaining=1)
+        with self.assertRaises(ValueError):
+            CreditService.deduct_credits(self.user, 'gpt-4o-mini', 1000, 500, request_id='req-1')
+        self.assertEqual(UserCreditBalance.objects.get(user=self.user).credits_remaining, 1)
+        self.assertFalse(CreditUsageLog.objects.filter(user=self.user).exists())
+
+    def test_deduct_credits_treats_empty_request_id_as_none(self):
+        CreditService.deduct_credits(self.user, 'gpt-4o-mini', 1000, 500, request_id='')
+        CreditService.deduct_credits(self.user, 'gpt-4o-mini', 1000, 500, request_id='')
+        self.assertEqual(UserCreditBalance.objects.get(user=self.user).credits_remaining, 496)
+        self.assertEqual(CreditUsageLog.objects.filter(user=self.user, request_id=None).count(), 2)
+
+    def test_deduct_credits_replays_duplicate_request_id(self):
+        first = CreditService.deduct_credits(self.user, 'gpt-4o-mini', 1000, 500, request_id='req-1')
+        with self.assertNumQueries(1):
+            retry = CreditService.deduct_credits(self.user, 'gpt-4o-mini', 1000, 500, request_id='req-1')
+        self.assertEqual(retry['usage_log_id'], first['usage_log_id'])
+        self.assertEqual(retry['credits_remaining'], 498)
+        self.assertEqual(UserCreditBalance.objects.get(user=self.user).credits_remaining, 498)
+        self.assertEqual(CreditUsageLog.objects.filter(user=self.user).count(), 1)
+
+    @override_settings(CREDIT_USAGE_LOG_BUFFERED=True)
+    @patch('bots.redis_pub.get_redis_client')
+    def test_deduct_credits_logs_keyed_request_synchronously(self, mock_get_redis_client):
+        with self.captureOnCommitCallbacks(execute=True):
+            result = CreditService.deduct_credits(self.user, 'gpt-4o-mini', 1000, 500, request_id='req-1')
+        self.assertTrue(CreditUsageLog.objects.filter(id=result['usage_log_id'], request_id='req-1').exists())
+        mock_get_redis_client.return_value.rpush.assert_not_called()
+
+    def test_add_credits_increments_in_database(self):
+        stale = UserCreditBalance.objects.get(user=self.user)
+        CreditService.add_credits(self.user, 100, 'Test')
+        stale.add_credits(50)
+        self.assertEqual(stale.credits_remaining, 650)
+        self.assertEqual(UserCreditBalance.objects.get(user=self.user).credits_remaining, 650)
+
+    def test_trial_model_restrictions_are_copied(self):
+        restrictions = CreditService.get_trial_model_restrictions()
+        restrictions['allowed_models'].append('gpt-4o')
+        self.assertEqual(CreditService.get_trial_model_restrictions()['allowed_models'], ['gpt-4o-mini'])
+
+    def test_credit_balance_reuses_loaded_relation(self):
+        user = User.objects.select_related('credit_balance').get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            balance = CreditService.get_or_create_credit_balance(user)
+            self.assertTrue(CreditService.is_trial_user(user))
+        self.assertEqual(balance.credits_remaining, 500)
+
+    @override_settings(CREDIT_USAGE_LOG_BUFFERED=True)
+    @patch('bots.redis_pub.get_redis_client')
+    def test_deduct_credits_buffers_usage_log(self, mock_get_redis_client):
+        with self.captureOnCommitCallbacks(execute=True):
+            result = CreditService.deduct_credits(self.user, 'gpt-4o-mini', 1000, 500)
+        self.assertIsNone(result['usage_log_id'])
+        self.assertFalse(CreditUsageLog.objects.filter(user=self.user).exists())
+        row = json.loads(mock_get_redis_client.return_value.rpush.call_args[0][1])
+        self.assertEqual(row['user_id'], self.user.id)
+        self.assertEqual(row['credits_deducted'], '1.500000')
+        self.assertIn('created_at', row)
+
+    @override_settings(CREDIT_USAGE_LOG_BUFFERED=True)
+    @patch('bots.redis_pub.get_redis_client')
+    def test_deduct_credits_logs_directly_when_redis_is_down(self, mock_get_redis_client):
+        mock_get_redis_client.return_value.rpush.side_effect = redis.ConnectionError('refused')
+        with self.captureOnCommitCallbacks(execute=True):
+            CreditService.deduct_credits(self.user, 'gpt-4o-mini', 1000, 500)
+        self.assertEqual(CreditUsageLog.objects.filter(user=self.user).count(), 1)
+
+    @patch('bots.redis_pub.get_redis_client')
+    def test_flush_credit_usage_logs_dead_letters_bad_rows(self, mock_get_redis_client):
+        deducted_at = timezone.now() - timedelta(minutes=5)
+        good = {
+            'user_id': self.user.id, 'model_id': self.model.id, 'bot_id': None,
+            'input_tokens': 10, 'output_tokens': 10, 'cost_usd': '0.000020',
+            'credits_deducted': '0.100000', 'request_id': None, 'created_at': deducted_at.isoformat()
+        }
+        bad = dict(good, input_tokens='ten')
+        rows = [json.dumps(good), json.dumps(bad)]
+        client = mock_get_redis_client.return_value
+        client.pipeline.return_value.execute.return_value = (rows, True)
+        flush_credit_usage_logs()
+        log = CreditUsageLog.objects.get(user=self.user)
+        self.assertEqual(log.created_at, deducted_at)
+        client.rpush.assert_called_once_with(CREDIT_USAGE_LOG_DEAD_LETTER_KEY, rows[1])
+        client.lpush.assert_not_called()
+
+class CreditUsageViewTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            full_name='Test User'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    @patch('subscription.throttles.CreditUsageBurstThrottle.timer', return_value=1000.0)
+    @patch('subscription.views.CreditService.deduct_credits', return_value={})
+    def test_credit_usage_burst_is_throttled(self, mock_deduct, mock_timer):
+        url = reverse('subscription:credit-usage')
+        payload = {'model_name': 'gpt-4o-mini', 'input_tokens': 10, 'output_tokens': 10}
+        for _ in range(20):
+            self.assertEqual(self.client.post(url, payload).status_code, status.HTTP_200_OK)
+        response = self.client.post(url, payload)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(mock_deduct.call_count, 20)
+
+class AdminCreditViewTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            full_name='Test User'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_admin_credit_usage_requires_staff(self):
+        url = reverse('subscription:admin-credit-usage')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_admin_credit_adjustment_requires_staff(self):
+        url = reverse('subscription:admin-credit-adjustment')
+        response = self.client.post(url, {'user_id': self.user.id, 'credits_to_add': 100})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(UserCreditBalance.objects.get(user=self.user).credits_remaining, 500)
+
+class CurrentSubscriptionTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            full_name='Test User'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.plan = SubscriptionPlan.objects.create(
+            name='Starter',
+            plan_type='starter',
+            stripe_price_id='price_starter',
+            price=Decimal('10.00')
+        )
+        self.subscription = Subscription.objects.create(
+            user=self.user,
+            plan=self.plan,
+            stripe_subscription_id='trial_sub',
+            status='active',
+            current_period_start=timezone.now(),
+            current_period_end=timezone.now() + timedelta(days=30)
+        )
+
+    def test_current_subscription_query_count(self):
+        url = reverse('subscription:current-subscription')
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['plan']['name'], 'Starter')
+        self.assertEqual(response.data['invoices'], [])
+
+    @patch('subscription.views.sync_subscription')
+    @patch('subscription.views.StripeService.sync_subscription_from_stripe')
+    def test_stale_paid_subscription_syncs_in_background(self, mock_sync, mock_task):
+        Subscription.objects.filter(pk=self.subscription.pk).update(
+            stripe_subscription_id='sub_paid',
+            updated_at=timezone.now() - timedelta(hours=2)
+        )
+        url = reverse('subscription:current-subscription')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_sync.assert_not_called()
+        mock_task.delay.assert_called_once_with('sub_paid')
+
+    def test_invoice_history_query_count(self):
+        for i in range(3):
+            Invoice.objects.create(
+                subscription=self.subscription,
+                stripe_invoice_id=f'in_{i}',
+                amount=Decimal('10.00'),
+                status='paid'
+            )
+        url = reverse('subscription:invoice-history')
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(len(response.data['invoices']), 3)
+        self.assertNotIn('count', response.data)
+
+    @patch('subscription.views.INVOICE_HISTORY_PAGE_SIZE', 2)
+    def test_invoice_history_pages_on_request(self):
+        for i in range(3):
+            Invoice.objects.create(
+                subscription=self.subscription,
+                stripe_invoice_id=f'in_{i}',
+                amount=Decimal('10.00'),
+                status='paid'
+            )
+        url = reverse('subscription:invoice-history')
+        response = self.client.get(url)
+        self.assertEqual(len(response.data['invoices']), 3)
+        response = self.client.get(url, {'page': 1})
+        self.assertEqual(len(response.data['invoices']), 2)
+        self.assertEqual(response.data['count'], 3)
+        self.assertIsNotNone(response.data['next'])
+        response = self.client.get(url, {'page': 2})
+        self.assertEqual(len(response.data['invoices']), 1)
+
+    def test_create_subscription_rejects_active_subscriber(self):
+        self.subscription.stripe_subscription_id = 'sub_paid'
+        self.subscription.save()
+        url = reverse('subscription:create-subscription')
+        response = self.client.post(url, {'plan_id': self.plan.id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], 'You already have an active subscription')
+
+class SubscriptionPlanListTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            full_name='Test User'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.plan = SubscriptionPlan.objects.create(
+            name='Starter',
+            plan_type='starter',
+            stripe_price_id='price_starter',
+            price=Decimal('10.00')
+        )
+
+    def test_plans_are_cached_until_a_plan_changes(self):
+        url = reverse('subscription:subscription-plans')
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.data[0]['name'], 'Starter')
+
+        self.plan.name = 'Starter Plus'
+        self.plan.save()
+        response = self.client.get(url)
+        self.assertEqual(response.data[0]['name'], 'Starter Plus')
+
+    def test_unchanged_plans_return_not_modified(self):
+        url = reverse('subscription:subscription-plans')
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.plan.price = Decimal('12.00')
+        self.plan.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+class PaymentMethodTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            full_name='Test User'
+        )
+        self.client.force_authenticate(user=self.user)
+        for i in range(2):
+            PaymentMethod.objects.create(
+                user=self.user,
+                stripe_payment_method_id=f'pm_{i}',
+                card_brand='visa',
+                card_last4='4242',
+                card_exp_month=12,
+                card_exp_year=2030,
+                is_default=(i == 0)
+            )
+
+    @patch('stripe.Customer.modify')
+    @patch('subscription.views.StripeService.get_or_create_customer')
+    def test_update_default_payment_method(self, mock_get_customer, mock_modify):
+        url = reverse('subscription:update-payment-method')
+        response = self.client.post(url, {'payment_method_id': 'pm_1'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        defaults = dict(PaymentMethod.objects.filter(user=self.user).values_list('stripe_payment_method_id', 'is_default'))
+        self.assertEqual(defaults, {'pm_0': False, 'pm_1': True})
+
+    @patch('stripe.Customer.modify')
+    @patch('stripe.PaymentMethod.retrieve')
+    @patch('stripe.PaymentMethod.attach')
+    @patch('subscription.views.StripeService.get_or_create_customer')
+    def test_create_payment_method_uses_attach_response(self, mock_get_customer, mock_attach, mock_retrieve, mock_modify):
+        PaymentMethod.objects.filter(user=self.user).delete()
+        mock_attach.return_value = stripe.PaymentMethod.construct_from({
+            'id': 'pm_new',
+            'card': {'brand': 'mastercard', 'last4': '4444', 'exp_month': 1, 'exp_year': 2031}
+        }, 'sk_test')
+        url = reverse('subscription:create-payment-method')
+        response = self.client.post(url, {'payment_method_id': 'pm_new'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['card_last4'], '4444')
+        self.assertTrue(response.data['is_default'])
+        mock_retrieve.assert_not_called()
+
+    @patch('stripe.Customer.modify')
+    @patch('stripe.PaymentMethod.attach')
+    @patch('subscription.views.StripeService.get_or_create_customer')
+    def test_create_payment_method_already_saved_by_webhook(self, mock_get_customer, mock_attach, mock_modify):
+        mock_attach.return_value = stripe.PaymentMethod.construct_from({
+            'id': 'pm_1',
+            'card': {'brand': 'visa', 'last4': '4242', 'exp_month': 12, 'exp_year': 2030}
+        }, 'sk_test')
+        url = reverse('subscription:create-payment-method')
+        response = self.client.post(url, {'payment_method_id': 'pm_1'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(PaymentMethod.objects.filter(stripe_payment_method_id='pm_1').count(), 1)
+
+    @patch('stripe.Customer.modify')
+    @patch('stripe.Subscription.create')
+    @patch('stripe.PaymentMethod.attach')
+    @patch('stripe.Customer.create')
+    def test_create_subscription_sets_default_payment_method_on_subscription(self, mock_create_customer, mock_attach, mock_create_subscription, mock_modify):
+        plan = SubscriptionPlan.objects.create(
+            name='Starter',
+            plan_type='starter',
+            stripe_price_id='price_starter',
+            price=Decimal('10.00')
+        )
+        mock_create_customer.return_value = stripe.Customer.construct_from({'id': 'cus_1'}, 'sk_test')
+        mock_create_subscription.return_value = stripe.Subscription.construct_from({'id': 'sub_1', 'status': 'trialing'}, 'sk_test')
+        url = reverse('subscription:create-subscription')
+        response = self.client.post(url, {'plan_id': plan.id, 'payment_method_id': 'pm_1'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(mock_create_subscription.call_args.kwargs['default_payment_method'], 'pm_1')
+        mock_create_customer.assert_called_once()
+        # pm_0 is still the user's default, so the customer's default is left as it is
+        mock_modify.assert_not_called()
+
+    @patch('stripe.Customer.modify')
+    @patch('stripe.Subscription.create')
+    @patch('stripe.PaymentMethod.attach')
+    @patch('stripe.Customer.create')
+    def test_create_subscription_makes_first_card_customer_default(self, mock_create_customer, mock_attach, mock_create_subscription, mock_modify):
+        PaymentMethod.objects.filter(user=self.user).delete()
+        plan = SubscriptionPlan.objects.create(
+            name='Starter',
+            plan_type='starter',
+            stripe_price_id='price_starter',
+            price=Decimal('10.00')
+        )
+        mock_create_customer.return_value = stripe.Customer.construct_from({'id': 'cus_1'}, 'sk_test')
+        mock_create_subscription.return_value = stripe.Subscription.construct_from({'id': 'sub_1', 'status': 'trialing'}, 'sk_test')
+        url = reverse('subscription:create-subscription')
+        response = self.client.post(url, {'plan_id': plan.id, 'payment_method_id': 'pm_new'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        mock_modify.assert_called_once_with('cus_1', invoice_settings={'default_payment_method': 'pm_new'})
+
+class StripeWebhookTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.event = {
+            'id': 'evt_1',
+            'type': 'invoice.created',
+            'data': {'object': {'id': 'in_1', 'subscription': 'sub_1'}}
+        }
+        self.url = reverse('subscription:stripe-webhook')
+
+    def post_event(self):
+        return self.client.post(self.url, data='{}', content_type='application/json', HTTP_STRIPE_SIGNATURE='sig')
+
+    @patch('subscription.views.handle_stripe_event')
+    @patch('stripe.Webhook.construct_event')
+    def test_duplicate_event_is_queued_once(self, mock_construct_event, mock_task):
+        mock_construct_event.return_value = self.event
+        for _ in range(2):
+            response = self.post_event()
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_task.delay.assert_called_once_with('evt_1', 'invoice.created', self.event['data']['object'])
+        self.assertEqual(WebhookEvent.objects.filter(stripe_event_id='evt_1').count(), 1)
+
+    @patch('stripe.Webhook.construct_event')
+    def test_oversized_payload_is_rejected_before_verification(self, mock_construct_event):
+        response = self.client.post(
+            self.url, data='{}', content_type='application/json',
+            HTTP_STRIPE_SIGNATURE='sig', CONTENT_LENGTH=str(STRIPE_WEBHOOK_MAX_BYTES + 1)
+        )
+        self.assertEqual(response.status_code, 413)
+        mock_construct_event.assert_not_called()
+
+    @patch('subscription.views.handle_stripe_event')
+    @patch('stripe.Webhook.construct_event')
+    def test_unhandled_event_type_is_acknowledged_without_work(self, mock_construct_event, mock_task):
+        mock_construct_event.return_value = dict(self.event, type='customer.updated')
+        with self.assertNumQueries(0):
+            response = self.post_event()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_task.delay.assert_not_called()
+
+    @patch('subscription.views.handle_stripe_event')
+    @patch('stripe.Webhook.construct_event')
+    def test_event_missing_from_cache_is_deduplicated_by_database(self, mock_construct_event, mock_task):
+        mock_construct_event.return_value = self.event
+        self.post_event()
+        cache.clear()
+        response = self.post_event()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_task.delay.assert_called_once()
+
+    def test_old_events_are_cleaned_up_in_one_delete(self):
+        WebhookEvent.objects.create(stripe_event_id='evt_old', event_type='invoice.created', data={'object': {'id': 'in_1'}})
+        WebhookEvent.objects.create(stripe_event_id='evt_new', event_type='invoice.created')
+        WebhookEvent.objects.filter(stripe_event_id='evt_old').update(processed_at=timezone.now() - timedelta(days=91))
+        with self.assertNumQueries(1):
+            cleanup_old_webhook_events()
+        self.assertEqual(list(WebhookEvent.objects.values_list('stripe_event_id', flat=True)), ['evt_new'])
+
+    @patch('subscription.views.handle_stripe_event')
+    @patch('stripe.Webhook.construct_event')
+    def test_retried_event_skips_database(self, mock_construct_event, mock_task):
+        mock_construct_event.return_value = self.event
+        self.post_event()
+        with self.assertNumQueries(0):
+            response = self.post_event()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_task.delay.assert_called_once()
+
+    @patch('subscription.views.handle_stripe_event')
+    @patch('stripe.Webhook.construct_event')
+    def test_unqueued_event_is_not_recorded(self, mock_construct_event, mock_task):
+        mock_construct_event.return_value = self.event
+        mock_task.delay.side_effect = ConnectionError('broker down')
+        response = self.post_event()
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertFalse(WebhookEvent.objects.filter(stripe_event_id='evt_1').exists())
+        # Stripe's retry must be processed, not acknowledged from the cache
+        mock_task.delay.side_effect = None
+        response = self.post_event()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(WebhookEvent.objects.filter(stripe_event_id='evt_1').exists())
+
+    @patch('subscription.views.handle_stripe_event')
+    @patch('stripe.Webhook.construct_event')
+    def test_unrecorded_event_is_processed_on_retry(self, mock_construct_event, mock_task):
+        mock_construct_event.return_value = self.event
+        with patch('subscription.views.WebhookEvent.objects.create', side_effect=OperationalError('database is locked')):
+            response = self.post_event()
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        mock_task.delay.assert_not_called()
+        response = self.post_event()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_task.delay.assert_called_once_with('evt_1', 'invoice.created', self.event['data']['object'])
+        self.assertTrue(WebhookEvent.objects.filter(stripe_event_id='evt_1').exists())
+
+    @patch.object(WebhookService, 'handle_invoice_created')
+    def test_task_routes_event_to_handler(self, mock_handler):
+        handle_stripe_event('evt_1', 'invoice.created', self.event['data']['object'])
+        mock_handler.assert_called_once_with(self.event['data']['object'])
+
+class WebhookServiceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            full_name='Test User'
+        )
+        self.period_end = timezone.now() + timedelta(days=30)
+        self.subscription = Subscription.objects.create(
+            user=self.user,
+            stripe_subscription_id='sub_1',
+            status='trialing',
+            current_period_start=timezone.now(),
+            current_period_end=self.period_end
+        )
+
+    def test_subscription_updated_without_period_keeps_stored_dates(self):
+        # Savepoint, one SELECT with the email joined in, the UPDATE, release; no user fetch
+        with self.assertNumQueries(4):
+            WebhookService.handle_subscription_updated({'id': 'sub_1', 'status': 'active'})
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.status, 'active')
+        self.assertEqual(self.subscription.current_period_end, self.period_end)
+
+    def test_subscription_deleted_writes_only_status_columns(self):
+        with self.assertNumQueries(4):
+            WebhookService.handle_subscription_deleted({'id': 'sub_1'})
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.status, 'canceled')
+        self.assertIsNotNone(self.subscription.canceled_at)
+        self.assertEqual(self.subscription.current_period_end, self.period_end)
+
+    @patch('subscription.tasks.send_payment_failed_notification')
+    def test_payment_failed_queues_email_by_subscription_id(self, mock_email_task):
+        with self.assertNumQueries(1):
+            WebhookService.handle_payment_failed({'subscription': 'sub_1'})
+        mock_email_task.delay.assert_called_once_with(self.subscription.id)
+
+    def test_subscription_created_skips_known_subscription(self):
+        plan = SubscriptionPlan.objects.create(
+            name='Starter',
+            plan_type='starter',
+            stripe_price_id='price_starter',
+            price=Decimal('10.00')
+        )
+        WebhookService.handle_subscription_created({
+            'id': 'sub_1',
+            'customer': 'cus_1',
+            'status': 'active',
+            'metadata': {'user_id': str(self.user.id), 'plan_id': str(plan.id)}
+        })
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.status, 'trialing')
+        self.assertIsNone(self.subscription.plan)
+
+    @patch('subscription.tasks.send_payment_success_notification')
+    @patch('subscription.services.StripeService.sync_subscription_from_stripe')
+    def test_payment_succeeded_updates_existing_invoice(self, mock_sync, mock_email_task):
+        Invoice.objects.create(
+            subscription=self.subscription,
+            stripe_invoice_id='in_1',
+            amount=Decimal('10.00'),
+            status='open'
+        )
+        with self.assertNumQueries(8), self.captureOnCommitCallbacks(execute=True):
+            WebhookService.handle_payment_succeeded({
+                'id': 'in_1',
+                'subscription': 'sub_1',
+                'amount_paid': 2500,
+                'status': 'paid',
+                'hosted_invoice_url': 'https://invoice.stripe.com/i/in_1'
+            })
+        invoice = Invoice.objects.get(stripe_invoice_id='in_1')
+        self.assertEqual(invoice.status, 'paid')
+        self.assertEqual(invoice.amount, Decimal('25.00'))
+        self.assertEqual(invoice.hosted_invoice_url, 'https://invoice.stripe.com/i/in_1')
+        mock_email_task.delay.assert_called_once_with(
+            self.subscription.id, '25.0', 'in_1', 'https://invoice.stripe.com/i/in_1'
+        )
+
+    @patch('subscription.tasks.send_payment_success_notification')
+    @patch('subscription.services.StripeService.sync_subscription_from_stripe')
+    @patch('subscription.services.CreditService.reset_credits_for_billing_cycle', side_effect=RuntimeError('boom'))
+    @patch('subscription.services.CreditService.is_billing_cycle_renewal', return_value=True)
+    def test_payment_succeeded_rolls_back_on_credit_reset_failure(self, mock_renewal, mock_reset, mock_sync, mock_email_task):
+        with self.captureOnCommitCallbacks(execute=True):
+            WebhookService.handle_payment_succeeded({'id': 'in_1', 'subscription': 'sub_1', 'amount_paid': 2500})
+        self.assertFalse(Invoice.objects.filter(stripe_invoice_id='in_1').exists())
+        mock_email_task.delay.assert_not_called()
+
+    @patch('subscription.tasks.send_payment_success_notification')
+    @patch('stripe.Subscription.retrieve')
+    def test_payment_succeeded_syncs_from_expanded_subscription(self, mock_retrieve, mock_email_task):
+        WebhookService.handle_payment_succeeded({
+            'id': 'in_1',
+            'subscription': {
+                'id': 'sub_1',
+                'status': 'active',
+                'current_period_start': 1767225600,
+                'current_period_end': 1769904000
+            },
+            'amount_paid': 2500,
+            'status': 'paid',
+            'invoice_pdf': None
+        })
+        mock_retrieve.assert_not_called()
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.status, 'active')
+        self.assertEqual(self.subscription.current_period_end.timestamp(), 1769904000)
+        self.assertTrue(Invoice.objects.filter(stripe_invoice_id='in_1', subscription=self.subscription).exists())
+
+    @patch('subscription.tasks.send_payment_success_notification')
+    @patch('stripe.Subscription.retrieve', side_effect=stripe.error.APIConnectionError('connection reset'))
+    def test_transient_stripe_errors_reach_the_webhook_task(self, mock_retrieve, mock_email_task):
+        plan = SubscriptionPlan.objects.create(name='Pro', plan_type='pro', stripe_price_id='price_pro', price=Decimal('20.00'))
+        with self.assertRaises(stripe.error.APIConnectionError):
+            WebhookService.handle_checkout_completed({
+                'subscription': 'sub_new',
+                'metadata': {'user_id': str(self.user.id), 'plan_id': str(plan.id)}
+            })
+        with self.assertRaises(stripe.error.APIConnectionError):
+            WebhookService.handle_payment_succeeded({'id': 'in_1', 'subscription': 'sub_new', 'amount_paid': 2500})
+        self.assertFalse(Invoice.objects.exists())
+
+    @patch('subscription.tasks.sync_subscription')
+    @patch('subscription.tasks.send_payment_success_notification')
+    @patch('stripe.Subscription.retrieve', side_effect=stripe.error.APIConnectionError('connection reset'))
+    def test_failed_sync_after_payment_is_deferred(self, mock_retrieve, mock_email_task, mock_sync_task):
+        with self.captureOnCommitCallbacks(execute=True):
+            WebhookService.handle_payment_succeeded({'id': 'in_1', 'subscription': 'sub_1', 'amount_paid': 2500})
+        self.assertTrue(Invoice.objects.filter(stripe_invoice_id='in_1').exists())
+        mock_email_task.delay.assert_called_once()
+        mock_sync_task.delay.assert_called_once_with('sub_1')
+
+    @patch('stripe.Subscription.retrieve')
+    def test_checkout_for_known_subscription_skips_stripe(self, mock_retrieve):
+        plan = SubscriptionPlan.objects.create(
+            name='Pro',
+            plan_type='pro',
+            stripe_price_id='price_pro',
+            price=Decimal('20.00'),
+            credits_per_month=5000
+        )
+        WebhookService.handle_checkout_completed({
+            'subscription': 'sub_1',
+            'metadata': {'user_id': str(self.user.id), 'plan_id': str(plan.id)}
+        })
+        mock_retrieve.assert_not_called()
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.plan, plan)
+        self.assertEqual(UserCreditBalance.objects.get(user=self.user).credits_remaining, 5000)
+
+    @patch('stripe.Subscription.retrieve')
+    def test_missing_subscription_is_created_from_expanded_object(self, mock_retrieve):
+        other_user = User.objects.create_user(
+            email='other@example.com',
+            password='testpass123',
+            full_name='Other User',
+            stripe_customer_id='cus_2'
+        )
+        subscription, stripe_subscription = WebhookService.get_or_create_local_subscription('sub_2', {
+            'id': 'sub_2',
+            'customer': 'cus_2',
+            'status': 'active',
+            'current_period_start': 1767225600,
+            'current_period_end': 1769904000
+        })
+        mock_retrieve.assert_not_called()
+        self.assertEqual(subscription.user, other_user)
+        self.assertEqual(subscription.stripe_customer_id, 'cus_2')
+        self.assertEqual(stripe_subscription['id'], 'sub_2')
+
+    def test_late_invoice_created_keeps_the_paid_invoice(self):
+        Invoice.objects.create(
+            subscription=self.subscription,
+            stripe_invoice_id='in_1',
+            amount=Decimal('25.00'),
+            status='paid'
+        )
+        invoice_data = {'id': 'in_1', 'subscription': 'sub_1', 'amount_due': 2500, 'currency': 'usd', 'status': 'open', 'invoice_pdf': None}
+        with self.assertNumQueries(2):
+            WebhookService.handle_invoice_created(invoice_data)
+        self.assertEqual(Invoice.objects.get(stripe_invoice_id='in_1').status, 'paid')
+
+        WebhookService.handle_invoice_created(dict(invoice_data, id='in_2'))
+        self.assertEqual(Invoice.objects.get(stripe_invoice_id='in_2').invoice_pdf, '')
+
+    def test_payment_method_attached_keeps_default_and_ignores_replays(self):
+        self.subscription.stripe_customer_id = 'cus_1'
+        self.subscription.save()
+        PaymentMethod.objects.create(
+            user=self.user,
+            stripe_payment_method_id='pm_old',
+            card_brand='visa',
+            card_last4='1111',
+            card_exp_month=1,
+            card_exp_year=2030,
+            is_default=True
+        )
+        payment_method_data = {
+            'id': 'pm_new',
+            'customer': 'cus_1',
+            'card': {'brand': 'visa', 'last4': '4242', 'exp_month': 12, 'exp_year': 2031}
+        }
+        WebhookService.handle_payment_method_attached(payment_method_data)
+        WebhookService.handle_payment_method_attached(payment_method_data)
+        self.assertEqual(PaymentMethod.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(
+            list(PaymentMethod.objects.filter(user=self.user, is_default=True).values_list('stripe_payment_method_id', flat=True)),
+            ['pm_old']
+        )
+
+        PaymentMethod.objects.filter(user=self.user).delete()
+        WebhookService.handle_payment_method_attached(payment_method_data)
+        self.assertTrue(PaymentMethod.objects.get(stripe_payment_method_id='pm_new').is_default)
+
+    @patch('stripe.Customer.retrieve')
+    def test_customer_is_resolved_locally_once_linked(self, mock_retrieve):
+        mock_retrieve.return_value = stripe.Customer.construct_from({'id': 'cus_new', 'email': self.user.email}, 'sk_test')
+        self.assertEqual(WebhookService.get_user_for_customer('cus_new'), self.user)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.stripe_customer_id, 'cus_new')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(WebhookService.get_user_for_customer('cus_new'), self.user)
+        self.assertEqual(mock_retrieve.call_count, 1)
+
+    @patch('stripe.Customer.retrieve')
+    def test_customer_dict_from_task_payload_is_resolved_by_email(self, mock_retrieve):
+        customer = {'id': 'cus_dict', 'email': self.user.email}
+        self.assertEqual(WebhookService.get_user_for_customer('cus_dict', customer), self.user)
+        mock_retrieve.assert_not_called()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.stripe_customer_id, 'cus_dict')
+
+    def test_plan_for_price_is_cached_until_plans_change(self):
+        plan = SubscriptionPlan.objects.create(
+            name='Starter',
+            plan_type='starter',
+            stripe_price_id='price_starter',
+            price=Decimal('10.00')
+        )
+        self.assertEqual(WebhookService.get_plan_for_price('price_starter'), plan)
+        with self.assertNumQueries(0):
+            self.assertIsNone(WebhookService.get_plan_for_price('price_unknown'))
+        plan.stripe_price_id = 'price_starter_v2'
+        plan.save()
+        self.assertEqual(WebhookService.get_plan_for_price('price_starter_v2'), plan)
+        with self.assertNumQueries(0):
+            self.assertEqual(WebhookService.get_plan_by_id(str(plan.id)), plan)
+            self.assertIsNone(WebhookService.get_plan_by_id('0'))
+
+    @patch('stripe.Invoice.list')
+    def test_invoice_history_sync_inserts_in_one_query(self, mock_list):
+        Invoice.objects.create(
+            subscription=self.subscription,
+            stripe_invoice_id='in_1',
+            amount=Decimal('25.00'),
+            status='paid'
+        )
+        mock_list.return_value = stripe.ListObject.construct_from({'data': [
+            {'id': f'in_{i}', 'amount_paid': 2500, 'currency': 'usd', 'status': 'open',
+             'invoice_pdf': None, 'hosted_invoice_url': None}
+            for i in range(1, 4)
+        ]}, 'sk_test')
+        with self.assertNumQueries(1):
+            StripeService.get_invoice_history(self.subscription)
+        self.assertEqual(self.subscription.invoices.count(), 3)
+        self.assertEqual(Invoice.objects.get(stripe_invoice_id='in_1').status, 'paid')
+
+    @patch('subscription.services.time.sleep')
+    def test_stripe_retry_backs_off_on_rate_limit(self, mock_sleep):
+        fetch = Mock(side_effect=[
+            stripe.error.RateLimitError('slow down', headers={'Retry-After': '2'}),
+            stripe.error.APIConnectionError('reset'),
+            'sub_1'
+        ])
+        self.assertEqual(stripe_retry(fetch)('sub_1'), 'sub_1')
+        self.assertEqual([call.args[0] for call in mock_sleep.call_args_list], [2.0, 2])
+
+    @patch('subscription.services.time.sleep')
+    def test_stripe_retry_ignores_non_numeric_retry_after(self, mock_sleep):
+        fetch = Mock(side_effect=[
+            stripe.error.RateLimitError('slow down', headers={'Retry-After': 'Wed, 21 Oct 2026 07:28:00 GMT'}),
+            'sub_1'
+        ])
+        self.assertEqual(stripe_retry(fetch)('sub_1'), 'sub_1')
+        mock_sleep.assert_called_once_with(1)
+
+    @patch('subscription.services.time.sleep')
+    def test_stripe_retry_gives_up_after_last_attempt(self, mock_sleep):
+        fetch = Mock(side_effect=stripe.error.RateLimitError('slow down'))
+        with self.assertRaises(stripe.error.RateLimitError):
+            stripe_retry(fetch)('sub_1')
+        self.assertEqual(fetch.call_count, 3)
+
+    @patch('subscription.services.time.sleep')
+    @patch.object(StripeService, 'sync_subscription_from_object')
+    @patch('stripe.Subscription.retrieve')
+    def test_sync_subscription_retries_rate_limited_read(self, mock_retrieve, mock_sync, mock_sleep):
+        stripe_subscription = stripe.Subscription.construct_from({'id': 'sub_1'}, 'sk_test')
+        mock_retrieve.side_effect = [stripe.error.RateLimitError('slow down'), stripe_subscription]
+        StripeService.sync_subscription_from_stripe('sub_1')
+        self.assertEqual(mock_retrieve.call_count, 2)
+        mock_sync.assert_called_once_with(stripe_subscription)
+
+    @patch('stripe.Subscription.retrieve')
+    def test_checkout_completed_updates_existing_subscription(self, mock_retrieve):
+        plan = SubscriptionPlan.objects.create(
+            name='Starter',
+            plan_type='starter',
+            stripe_price_id='price_starter',
+            price=Decimal('10.00')
+        )
+        mock_retrieve.return_value = stripe.Subscription.construct_from({
+            'id': 'sub_2',
+            'customer': 'cus_1',
+            'status': 'active',
+            'current_period_start': 1767225600,
+            'current_period_end': 1769904000
+        }, 'sk_test')
+        WebhookService.handle_checkout_completed({
+            'subscription': 'sub_2',
+            'metadata': {'user_id': str(self.user.id), 'plan_id': str(plan.id)}
+        })
+        subscription = Subscription.objects.get(user=self.user)
+        self.assertEqual(subscription.pk, self.subscription.pk)
+        self.assertEqual(subscription.stripe_subscription_id, 'sub_2')
+        self.assertEqual(subscription.status, 'active')
+        self.assertEqual(subscription.plan, plan)
+        self.assertEqual(subscription.current_period_end.timestamp(), 1769904000)
+
+    @patch.object(WebhookService, 'handle_subscription_updated')
+    @patch('stripe.Subscription.retrieve')
+    def test_subscription_event_drops_cached_stripe_subscription(self, mock_retrieve, mock_handler):
+        mock_retrieve.return_value = stripe.Subscription.construct_from({'id': 'sub_1', 'status': 'trialing'}, 'sk_test')
+        StripeService.retrieve_subscription('sub_1')
+        StripeService.retrieve_subscription('sub_1')
+        self.assertEqual(mock_retrieve.call_count, 1)
+
+        WebhookService.handle_event('customer.subscription.updated', {'id': 'sub_1', 'status': 'active'})
+        StripeService.retrieve_subscription('sub_1')
+        self.assertEqual(mock_retrieve.call_count, 2)
+
+    @patch('stripe.Subscription.retrieve')
+    def test_cached_stripe_subscription_holds_no_api_key(self, mock_retrieve):
+        mock_retrieve.return_value = stripe.Subscription.construct_from({'id': 'sub_1', 'status': 'trialing'}, 'sk_test_secret')
+        StripeService.retrieve_subscription('sub_1')
+        self.assertEqual(cache.get('stripe_sub:sub_1'), {'id': 'sub_1', 'status': 'trialing'})
+        cached = StripeService.retrieve_subscription('sub_1')
+        self.assertEqual(cached.status, 'trialing')
+        self.assertEqual(mock_retrieve.call_count, 1)
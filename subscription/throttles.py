@@ -0,0 +1,13 @@
+from rest_framework.throttling import UserRateThrottle
+
+
+class CreditUsageThrottle(UserRateThrottle):
+    """Sustained per-user limit on credit deductions"""
+    scope = 'credit_usage'
+    rate = '100/min'
+
+
+class CreditUsageBurstThrottle(UserRateThrottle):
+    """Caps how many deductions a single user can fire at once"""
+    scope = 'credit_usage_burst'
+    rate = '20/sec'
@@ -1,84 +1,132 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework import status
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.utils.encoders import JSONEncoder
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.cache import cache
 from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F, Sum, Count, Case, When, Value, BooleanField
 import stripe
+import hashlib
 import json
-from datetime import datetime, timedelta, timezone as dt_timezone
 import logging
-import traceback
 
 from .models import Subscription, SubscriptionPlan, PaymentMethod, Invoice, WebhookEvent, AIModel, UserCreditBalance, CreditUsageLog
 from .serializers import (
     SubscriptionSerializer, SubscriptionPlanSerializer, PaymentMethodSerializer,
     CreateSubscriptionSerializer, CancelSubscriptionSerializer, UpdatePaymentMethodSerializer,
-    AIModelSerializer, UserCreditBalanceSerializer, CreditUsageLogSerializer,
+    AIModelSerializer, UserCreditBalanceSerializer,
     CreditUsageRequestSerializer, AdminCreditAdjustmentSerializer, InvoiceSerializer
 )
-from .services import StripeService, CreditService
+from .tasks import handle_stripe_event, sync_subscription
+from .throttles import CreditUsageThrottle, CreditUsageBurstThrottle
+from .exceptions import billing_exception_handler
+from .services import (
+    StripeService, CreditService, WebhookService, CREDIT_SUMMARY_CACHE_TTL,
+    SUBSCRIPTION_PLANS_CACHE_KEY, SUBSCRIPTION_PLANS_CACHE_TTL, SUBSCRIPTION_SYNC_MAX_AGE
+)
 from django.conf import settings
-from bots.services import NotificationService
-from email_templates.email_service import EmailService
 
 logger = logging.getLogger(__name__)
 
+# Same shape as CreditUsageLogSerializer output
+CREDIT_USAGE_LOG_FIELDS = (
+    'id', 'model', 'bot', 'input_tokens', 'output_tokens', 'cost_usd',
+    'credits_deducted', 'request_id', 'created_at'
+)
+
+# Stripe events are a few KB; anything past this is rejected before the signature is hashed
+STRIPE_WEBHOOK_MAX_BYTES = 1024 * 1024
+
+# Invoices returned per page of InvoiceHistoryView
+INVOICE_HISTORY_PAGE_SIZE = 25
+
+# Usage logs returned per page of CreditUsageLogView
+CREDIT_USAGE_LOG_PAGE_SIZE = 50
+
+# Stripe event IDs seen recently; Stripe retries for up to three days but most arrive within one
+STRIPE_EVENT_SEEN_CACHE_KEY = 'stripe_event_seen:{event_id}'
+STRIPE_EVENT_SEEN_CACHE_TTL = 86400
+
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
 # Get the User model
 User = get_user_model()
 
-def is_event_processed(event_id):
-    """Check if a webhook event has already been processed"""
-    return WebhookEvent.objects.filter(stripe_event_id=event_id).exists()
-
-def mark_event_processed(event_id, event_type, event_data=None):
-    """Mark a webhook event as processed"""
-    try:
-        WebhookEvent.objects.create(
-            stripe_event_id=event_id,
-            event_type=event_type,
-            data=event_data or {}
-        )
-        return True
-    except Exception as e:
-        print(f"Error marking event as processed: {str(e)}")
-        return False
+def credit_usage_log_rows(logs, *extra_fields):
+    """Project usage logs onto the serialized columns for read-only endpoints"""
+    return logs.values(
+        *CREDIT_USAGE_LOG_FIELDS,
+        *extra_fields,
+        model_name=F('model__display_name'),
+        model_provider=F('model__provider')
+    )
+
+def format_credit_usage_log(row):
+    """Keep decimals as strings, matching the DRF DecimalField output"""
+    row['cost_usd'] = f"{row['cost_usd']:f}"
+    row['credits_deducted'] = f"{row['credits_deducted']:f}"
+    return row
+
+def stream_credit_usage_logs(logs, *extra_fields):
+    """Stream usage logs as a JSON array without materializing the queryset"""
+    yield '['
+    rows = credit_usage_log_rows(logs, *extra_fields).iterator(chunk_size=2000)
+    for i, row in enumerate(rows):
+        yield (',' if i else '') + json.dumps(format_credit_usage_log(row), cls=JSONEncoder)
+    yield ']'
+
+class BillingErrorHandlingMixin:
+    """Views that only catch the errors they expect; anything else becomes a logged JSON 500"""
+    def get_exception_handler(self):
+        return billing_exception_handler
 
 class SubscriptionPlanListView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
-        plans = SubscriptionPlan.objects.filter(is_active=True)
-        serializer = SubscriptionPlanSerializer(plans, many=True)
-        return Response(serializer.data)
+        cached = cache.get_or_set(SUBSCRIPTION_PLANS_CACHE_KEY, self._build_plans, SUBSCRIPTION_PLANS_CACHE_TTL)
+        etag = f'"{cached["etag"]}"'
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response(cached['plans'], headers={'ETag': etag})
+
+    @staticmethod
+    def _build_plans():
+        # The ETag is hashed once per cache fill, not on every request
+        plans = list(SubscriptionPlanSerializer(SubscriptionPlan.objects.filter(is_active=True), many=True).data)
+        body = json.dumps(plans, cls=JSONEncoder, sort_keys=True).encode()
+        return {'plans': plans, 'etag': hashlib.md5(body).hexdigest()}
 
 class CurrentSubscriptionView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
-        # Get the most recent active subscription for the user
-        subscription = Subscription.objects.filter(
+        # Get the most recent active subscription for the user, with everything the serializer reads
+        subscription = Subscription.objects.select_related('plan').prefetch_related('invoices').filter(
             user=request.user,
             status__in=['trialing', 'active']
         ).order_by('-created_at').first()
         
         if subscription:
-            # If this is a paid subscription, ensure it has the correct billing period
+            # Webhooks keep paid subscriptions current; only re-sync stale rows, in the background
             if subscription.plan and not subscription.is_trialing:
-                # Sync with Stripe to ensure we have the latest data
-                try:
-                    if subscription.stripe_subscription_id and not subscription.stripe_subscription_id.startswith('trial_'):
-                        StripeService.sync_subscription_from_stripe(subscription.stripe_subscription_id)
-                        subscription.refresh_from_db()
-                        logger.info(f"  - Synced from Stripe, new current_period_end: {subscription.current_period_end}")
-                except Exception as e:
-                    logger.error(f"Error syncing subscription from Stripe: {e}")
+                if (
+                    subscription.stripe_subscription_id
+                    and not subscription.stripe_subscription_id.startswith('trial_')
+                    and subscription.updated_at < timezone.now() - SUBSCRIPTION_SYNC_MAX_AGE
+                ):
+                    try:
+                        sync_subscription.delay(subscription.stripe_subscription_id)
+                    except Exception as e:
+                        logger.error(f"Error queueing subscription sync: {e}")
             
             serializer = SubscriptionSerializer(subscription)
             return Response(serializer.data)
@@ -93,22 +141,24 @@ class CreateSubscriptionView(APIView):
             try:
                 plan = get_object_or_404(SubscriptionPlan, id=serializer.validated_data['plan_id'])
                 
-                # Check if user already has an active subscription
+                # Check if user already has an active subscription; only its Stripe ID is needed.
+                # The subscription row may exist with a NULL Stripe ID, so fetch the row as a tuple
                 existing_subscription = Subscription.objects.filter(
                     user=request.user,
                     status__in=['trialing', 'active']
-                ).first()
-                
+                ).values_list('stripe_subscription_id').first()
+                existing_sub_stripe_id = existing_subscription[0] if existing_subscription else None
+
+                # Check if this is a trial user
+                is_trial_user = bool(existing_sub_stripe_id and existing_sub_stripe_id.startswith('trial_'))
+
                 # Allow trial users to create new subscriptions
-                if existing_subscription and not (existing_subscription.stripe_subscription_id and existing_subscription.stripe_subscription_id.startswith('trial_')):
+                if existing_subscription and not is_trial_user:
                     return Response(
                         {'error': 'You already have an active subscription'},
                         status=400
                     )
                 
-                # Check if this is a trial user
-                is_trial_user = existing_subscription and existing_subscription.stripe_subscription_id and existing_subscription.stripe_subscription_id.startswith('trial_')
-                
                 # For new subscriptions without payment method, create checkout session
                 if not serializer.validated_data.get('payment_method_id'):
                     try:
@@ -169,20 +219,16 @@ class CreateSubscriptionView(APIView):
                         customer=customer.id
                     )
                     
-                    # Set as default payment method
-                    stripe.Customer.modify(
-                        customer.id,
-                        invoice_settings={
-                            'default_payment_method': payment_method_id
-                        }
-                    )
+                    # Same rule as CreatePaymentMethodView: a first card becomes the customer's default
+                    StripeService.set_default_payment_method_if_missing(request.user, customer.id, payment_method_id)
                     
-                    # Create subscription
+                    # Create subscription with the payment method as its default
                     subscription = StripeService.create_subscription(
                         request.user,
                         plan,
                         payment_method_id,
-                        serializer.validated_data.get('trial_from_plan', True)
+                        serializer.validated_data.get('trial_from_plan', True),
+                        customer=customer
                     )
                     
                     # Allocate credits for new subscription
@@ -260,36 +306,30 @@ class CreatePaymentMethodView(APIView):
                 logger.error(f"Error getting or creating customer: {e}")
                 return Response({'error': 'Failed to get or create customer'}, status=500)
             
-            # Attach payment method to customer
-            stripe.PaymentMethod.attach(
+            # Attach payment method to customer; the response carries the card details
+            payment_method_data = stripe.PaymentMethod.attach(
                 payment_method_id,
                 customer=customer.id
             )
             
             # Set as default if no default exists
-            existing_default = PaymentMethod.objects.filter(user=request.user, is_default=True).first()
-            is_default = not existing_default
-            
-            if is_default:
-                stripe.Customer.modify(
-                    customer.id,
-                    invoice_settings={'default_payment_method': payment_method_id}
-                )
+            is_default = StripeService.set_default_payment_method_if_missing(request.user, customer.id, payment_method_id)
             
-            # Save payment method
-            payment_method_data = stripe.PaymentMethod.retrieve(payment_method_id)
-            payment_method = PaymentMethod.objects.create(
-                user=request.user,
+            # Save payment method; the payment_method.attached webhook may have saved it already
+            payment_method, created = PaymentMethod.objects.get_or_create(
                 stripe_payment_method_id=payment_method_id,
-                card_brand=payment_method_data.card.brand,
-                card_last4=payment_method_data.card.last4,
-                card_exp_month=payment_method_data.card.exp_month,
-                card_exp_year=payment_method_data.card.exp_year,
-                is_default=is_default
+                defaults={
+                    'user': request.user,
+                    'card_brand': payment_method_data.card.brand,
+                    'card_last4': payment_method_data.card.last4,
+                    'card_exp_month': payment_method_data.card.exp_month,
+                    'card_exp_year': payment_method_data.card.exp_year,
+                    'is_default': is_default
+                }
             )
             
             serializer = PaymentMethodSerializer(payment_method)
-            return Response(serializer.data, status=201)
+            return Response(serializer.data, status=201 if created else 200)
         except Exception as e:
             logger.error(f"Error creating payment method: {e}")
             return Response({'error': 'Failed to create payment method'}, status=500)
@@ -310,12 +350,14 @@ class UpdatePaymentMethodView(APIView):
                     invoice_settings={'default_payment_method': payment_method_id}
                 )
                 
-                # Update local payment methods
-                PaymentMethod.objects.filter(user=request.user).update(is_default=False)
-                PaymentMethod.objects.filter(
-                    user=request.user,
-                    stripe_payment_method_id=payment_method_id
-                ).update(is_default=True)
+                # Update local payment methods in a single UPDATE
+                PaymentMethod.objects.filter(user=request.user).update(
+                    is_default=Case(
+                        When(stripe_payment_method_id=payment_method_id, then=Value(True)),
+                        default=Value(False),
+                        output_field=BooleanField()
+                    )
+                )
                 
                 return Response({'message': 'Default payment method updated'})
             except Exception as e:
@@ -328,14 +370,23 @@ class InvoiceHistoryView(APIView):
     
     def get(self, request):
         try:
-            subscription = Subscription.objects.filter(user=request.user).first()
-            if not subscription:
-                return Response({'invoices': []})
-        
-            invoices = Invoice.objects.filter(subscription=subscription).order_by('-created_at')
+            # Join through the subscription; users without one just get an empty list
+            invoices = Invoice.objects.filter(subscription__user=request.user).order_by('-created_at')
+            # Clients that page get a bounded response; the full history stays for existing callers
+            if request.query_params.get('page'):
+                paginator = PageNumberPagination()
+                paginator.page_size = INVOICE_HISTORY_PAGE_SIZE
+                page = paginator.paginate_queryset(invoices, request)
+                serializer = InvoiceSerializer(page, many=True)
+                return Response({
+                    'invoices': serializer.data,
+                    'count': paginator.page.paginator.count,
+                    'next': paginator.get_next_link(),
+                    'previous': paginator.get_previous_link()
+                })
             serializer = InvoiceSerializer(invoices, many=True)
             return Response({'invoices': serializer.data})
-        except Exception as e:
+        except DatabaseError as e:
             logger.error(f"Error fetching invoice history: {e}")
             return Response({'error': 'Failed to fetch invoice history'}, status=500)
 
@@ -352,7 +403,7 @@ class UpgradeSubscriptionView(APIView):
             new_plan = get_object_or_404(SubscriptionPlan, id=new_plan_id)
             
             # Get current subscription to determine if it's an upgrade or downgrade
-            current_subscription = Subscription.objects.filter(
+            current_subscription = Subscription.objects.select_related('plan').filter(
                 user=request.user,
                 status__in=['trialing', 'active']
             ).order_by('-created_at').first()
@@ -380,6 +431,13 @@ class StripeWebhookView(APIView):
     permission_classes = [AllowAny]
     
     def post(self, request):
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return HttpResponse(status=400)
+        if content_length > STRIPE_WEBHOOK_MAX_BYTES:
+            return HttpResponse(status=413)
+        
         payload = request.body
         sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
         
@@ -392,423 +450,49 @@ class StripeWebhookView(APIView):
         except stripe.error.SignatureVerificationError as e:
             return HttpResponse(status=400)
         
-        # Check if event has already been processed
-        if is_event_processed(event['id']):
-            return HttpResponse(status=200)
-        
         event_type = event['type']
         event_data = event['data']['object']
         
-        try:
-            if event_type == 'customer.subscription.created':
-                self.handle_subscription_created(event_data)
-            elif event_type == 'customer.subscription.updated':
-                self.handle_subscription_updated(event_data)
-            elif event_type == 'customer.subscription.deleted':
-                self.handle_subscription_deleted(event_data)
-            elif event_type == 'invoice.payment_succeeded':
-                self.handle_payment_succeeded(event_data)
-            elif event_type == 'invoice.payment_failed':
-                self.handle_payment_failed(event_data)
-            elif event_type == 'checkout.session.completed':
-                self.handle_checkout_completed(event_data)
-            elif event_type == 'invoice.created':
-                self.handle_invoice_created(event_data)
-            elif event_type == 'payment_method.attached':
-                self.handle_payment_method_attached(event_data)
-            
-            # Mark event as processed
-            mark_event_processed(event['id'], event_type, event_data)
-            
-        except Exception as e:
-            logger.error(f"Error processing webhook {event_type}: {e}")
-            return HttpResponse(status=500)
+        # Event types with no handler are acknowledged without a row or a task
+        if event_type not in WebhookService.HANDLERS:
+            return HttpResponse(status=200)
         
-        return HttpResponse(status=200)
-    
-    def handle_subscription_created(self, subscription_data):
-        """Handle subscription.created webhook"""
+        # Stripe retries of handled events are acknowledged from the cache without touching
+        # the database; the WebhookEvent row below stays the durable record
+        seen_key = STRIPE_EVENT_SEEN_CACHE_KEY.format(event_id=event['id'])
+        if cache.get(seen_key):
+            return HttpResponse(status=200)
+        
+        # Claim the event by inserting straight away and letting the unique
+        # stripe_event_id reject duplicates; the cache already filtered most of them
         try:
-            # Check if subscription already exists
-            existing_subscription = Subscription.objects.filter(stripe_subscription_id=subscription_data['id']).first()
-            if existing_subscription:
-                logger.info(f"Subscription {subscription_data['id']} already exists")
-                return
-            
-            user_id = subscription_data.get('metadata', {}).get('user_id')
-            if not user_id:
-                logger.error("No user_id in subscription metadata")
-                return
-            
-            try:
-                user = User.objects.get(id=user_id)
-            except User.DoesNotExist:
-                logger.error(f"User {user_id} not found")
-                return
-            
-            # Get plan from metadata or find by price ID
-            plan_id = subscription_data.get('metadata', {}).get('plan_id')
-            plan = None
-            if plan_id:
-                try:
-                    plan = SubscriptionPlan.objects.get(id=plan_id)
-                except SubscriptionPlan.DoesNotExist:
-                    logger.error(f"Plan {plan_id} not found")
-            
-            if not plan:
-                # Try to find plan by price ID
-                price_id = subscription_data['items']['data'][0]['price']['id']
-                try:
-                    plan = SubscriptionPlan.objects.get(stripe_price_id=price_id)
-                except SubscriptionPlan.DoesNotExist:
-                    logger.error(f"Plan with price ID {price_id} not found")
-            
-            # Create subscription record
-            # Check if this is a trial user (has subscription ID that starts with 'trial_')
-            subscription_exists = Subscription.objects.filter(stripe_subscription_id=subscription_data['id']).exists()
-            if subscription_exists:
-                if subscription_data['id'].startswith('trial_'):
-                    # Delete any other trial subscriptions for this user
-                    Subscription.objects.filter(user=user, stripe_subscription_id__startswith='trial_').delete()
-            else:
-                subscription, created = Subscription.objects.update_or_create(
-                    user=user,
-                defaults={
-                    'plan': plan,
-                        'stripe_subscription_id': subscription_data['id'],
-                        'stripe_customer_id': subscription_data['customer'],
-                    'status': subscription_data['status'],
-                        'current_period_start': datetime.fromtimestamp(subscription_data['current_period_start'], tz=dt_timezone.utc),
-                        'current_period_end': datetime.fromtimestamp(subscription_data['current_period_end'], tz=dt_timezone.utc),
-                        'trial_start': datetime.fromtimestamp(subscription_data['trial_start'], tz=dt_timezone.utc) if subscription_data.get('trial_start') else None,
-                        'trial_end': datetime.fromtimestamp(subscription_data['trial_end'], tz=dt_timezone.utc) if subscription_data.get('trial_end') else None
-                        }
+            with transaction.atomic():
+                WebhookEvent.objects.create(
+                    stripe_event_id=event['id'],
+                    event_type=event_type,
+                    data=event_data
                 )
-                
-            # Allocate credits for new subscription
-            CreditService.allocate_credits_for_new_subscription(user, subscription)
-            
-            logger.info(f"Subscription created for user {user.email}")
-            
-        except Exception as e:
-            logger.error(f"Error handling subscription.created: {e}")
-    
-    def handle_subscription_updated(self, subscription_data):
-        """Handle subscription.updated webhook"""
-        try:
-            subscription = Subscription.objects.get(stripe_subscription_id=subscription_data['id'])
-            old_status = subscription.status
-            subscription.status = subscription_data['status']
-            subscription.current_period_start = datetime.fromtimestamp(subscription_data['current_period_start'], tz=dt_timezone.utc)
-            subscription.current_period_end = datetime.fromtimestamp(subscription_data['current_period_end'], tz=dt_timezone.utc)
-            subscription.save()
-            
-            # Only reset credits if this is a new billing cycle AND payment succeeded
-            # Don't reset credits just because status changed to active
-            # Credits should only reset when payment succeeds for the new billing cycle
-            if old_status != 'active' and subscription.status == 'active':
-                # This might be a new subscription, not a billing cycle renewal
-                # We'll handle credit reset in payment_succeeded webhook instead
-                pass
-            
-            logger.info(f"Subscription updated for user {subscription.user.email}")
-        except Subscription.DoesNotExist:
-            logger.error(f"Subscription {subscription_data['id']} not found")
-        except Exception as e:
-            logger.error(f"Error handling subscription.updated: {e}")
-    
-    def handle_subscription_deleted(self, subscription_data):
-        """Handle subscription.deleted webhook"""
-        try:
-            subscription = Subscription.objects.get(stripe_subscription_id=subscription_data['id'])
-            subscription.status = 'canceled'
-            subscription.canceled_at = timezone.now()
-            subscription.save()
-            
-            logger.info(f"Subscription canceled for user {subscription.user.email}")
-        except Subscription.DoesNotExist:
-            logger.error(f"Subscription {subscription_data['id']} not found")
-        except Exception as e:
-            logger.error(f"Error handling subscription.deleted: {e}")
-    
-    def handle_payment_succeeded(self, invoice_data):
-        """Handle invoice.payment_succeeded webhook"""
-        try:
-            subscription_id = invoice_data.get('subscription')
-            if not subscription_id:
-                logger.info("No subscription found for invoice")
-                return
-            
-            # Get subscription from database or create from Stripe
-            try:
-                subscription = Subscription.objects.get(stripe_subscription_id=subscription_id)
-                logger.info(f"Found subscription: {subscription.id} for user: {subscription.user.email}")
-            except Subscription.DoesNotExist:
-                logger.info(f"No subscription found for ID: {subscription_id}")
-                try:
-                    stripe_subscription = stripe.Subscription.retrieve(subscription_id)
-                    customer_id = stripe_subscription.customer
-
-                    try:
-                        customer = stripe.Customer.retrieve(customer_id)
-                        User = get_user_model()
-                        user = User.objects.get(email=customer.email)
-                    except Exception as e:
-                        logger.error(f"Error finding user for customer {customer_id}: {e}")
-                        return
-                    
-                    # Get plan from price ID
-                    plan = None
-                    if stripe_subscription.get('items') and stripe_subscription['items'].get('data'):
-                        price_id = stripe_subscription['items']['data'][0]['price']['id']
-                        try:
-                            plan = SubscriptionPlan.objects.get(stripe_price_id=price_id)
-                        except SubscriptionPlan.DoesNotExist:
-                            print(f"Plan with price {price_id} not found")
-                            return
-                    
-                    # Create subscription from Stripe data
-                    subscription, created = Subscription.objects.get_or_create(
-                        stripe_subscription_id=stripe_subscription.id,
-                        defaults={
-                            'user': user,
-                            'plan': plan,
-                            'stripe_customer_id': customer_id,
-                            'status': stripe_subscription.status,
-                            'current_period_start': datetime.fromtimestamp(stripe_subscription.get('current_period_start'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_start') else timezone.now(),
-                            'current_period_end': datetime.fromtimestamp(stripe_subscription.get('current_period_end'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_end') else timezone.now() + timedelta(days=30),
-                            'trial_start': datetime.fromtimestamp(stripe_subscription.get('trial_start'), tz=dt_timezone.utc) if stripe_subscription.get('trial_start') else None,
-                            'trial_end': datetime.fromtimestamp(stripe_subscription.get('trial_end'), tz=dt_timezone.utc) if stripe_subscription.get('trial_end') else None,
-                        }
-                    )
-                    if created:
-                        logger.info(f"Created subscription {subscription.id} from Stripe data for invoice")
-                    else:
-                        logger.info(f"Subscription {subscription.id} already exists from Stripe data")
-                except Exception as e:
-                    logger.error(f"Error getting subscription from Stripe: {str(e)}")
-                    return
-            
-            # Create or update invoice
-            invoice, created = Invoice.objects.get_or_create(
-                stripe_invoice_id=invoice_data['id'],
-                defaults={
-                    'subscription': subscription,
-                    'amount': (invoice_data.get('amount_paid') or invoice_data.get('amount_due') or 0) / 100,
-                    'currency': invoice_data.get('currency', 'usd'),
-                    'status': invoice_data.get('status', 'paid'),
-                    'invoice_pdf': invoice_data.get('invoice_pdf', ''),
-                    'hosted_invoice_url': invoice_data.get('hosted_invoice_url', ''),
-                }
-            )
-            if created:
-                logger.info(f"Created new invoice {invoice.id} for subscription {subscription.id}")
-            else:
-                # Update existing invoice
-                invoice.status = invoice_data.get('status', 'paid')
-                invoice.amount = (invoice_data.get('amount_paid') or invoice_data.get('amount_due') or 0) / 100
-                invoice.save()
-                logger.info(f"Updated existing invoice {invoice.id}")
-            
-            # Sync subscription status
-            StripeService.sync_subscription_from_stripe(subscription_id)
-            
-            # Send payment success email
-            try:
-                email_service = EmailService()
-                if email_service:
-                    success = email_service.send_payment_success_email(
-                        subscription,
-                        invoice.amount,
-                        invoice.stripe_invoice_id,
-                        invoice.hosted_invoice_url
-                    )
-                    if success:
-                        logger.info(f"Payment success email sent to {subscription.user.email}")
-                    else:
-                        logger.error(f"Failed to send payment success email to {subscription.user.email}")
-                else:
-                    logger.error("Email service not available")
-            except Exception as e:
-                logger.error(f"Exception sending payment success email to {subscription.user.email}: {str(e)}")
-            
-            # Only reset credits if this is a billing cycle renewal, not a new subscription
-            if CreditService.is_billing_cycle_renewal(subscription, invoice_data):
-                CreditService.reset_credits_for_billing_cycle(subscription.user, subscription)
-                logger.info(f"Credits reset for billing cycle renewal - user {subscription.user.email}")
-            else:
-                logger.info(f"Payment succeeded for new subscription - user {subscription.user.email}")
-            
-            logger.info(f"Payment succeeded for user {subscription.user.email}")
-            
-        except Subscription.DoesNotExist:
-            logger.error(f"Subscription {invoice_data['subscription']} not found - this may be normal for new subscriptions")
-        except Exception as e:
-            logger.error(f"Error handling payment.succeeded: {e}")
-    
-    def handle_payment_failed(self, invoice_data):
-        """Handle invoice.payment_failed webhook"""
-        try:
-            subscription = Subscription.objects.get(stripe_subscription_id=invoice_data['subscription'])
-            
-            # Send payment failed email
-            email_service = EmailService()
-            if email_service:
-                try:
-                    success = email_service.send_payment_failed_email(subscription)
-                    if success:
-                        logger.info(f"Payment failed email sent to {subscription.user.email}")
-                    else:
-                        logger.error(f"Failed to send payment failed email to {subscription.user.email}")
-                except Exception as e:
-                    logger.error(f"Exception sending payment failed email to {subscription.user.email}: {str(e)}")
-            
-            logger.info(f"Payment failed for user {subscription.user.email}")
-            
-        except Subscription.DoesNotExist:
-            logger.error(f"Subscription {invoice_data['subscription']} not found")
-        except Exception as e:
-            logger.error(f"Error handling payment.failed: {e}")
-    
-    def handle_checkout_completed(self, session_data):
-        """Handle checkout.session.completed webhook"""
-        try:
-            user_id = session_data.get('metadata', {}).get('user_id')
-            plan_id = session_data.get('metadata', {}).get('plan_id')
-            is_trial_upgrade = session_data.get('metadata', {}).get('is_trial_upgrade') == 'true'
-            
-            if not user_id or not plan_id:
-                logger.error("Missing user_id or plan_id in checkout session metadata")
-                return
-            
-            try:
-                user = User.objects.get(id=user_id)
-                plan = SubscriptionPlan.objects.get(id=plan_id)
-            except (User.DoesNotExist, SubscriptionPlan.DoesNotExist) as e:
-                logger.error(f"User or plan not found: {e}")
-                return
-            
-            # Get the subscription from Stripe
-            subscription_id = session_data.get('subscription')
-            if subscription_id:
-                try:
-                    stripe_subscription = stripe.Subscription.retrieve(subscription_id)
-
-                    # Use get_or_create to prevent duplicates
-                    subscription, created = Subscription.objects.get_or_create(
-                    user=user,
-                        defaults={
-                            'stripe_subscription_id': stripe_subscription.id,
-                            'plan': plan,
-                            'stripe_customer_id': stripe_subscription.customer,
-                            'status': stripe_subscription.status,
-                            'current_period_start': datetime.fromtimestamp(stripe_subscription.get('current_period_start'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_start') else timezone.now(),
-                            'current_period_end': datetime.fromtimestamp(stripe_subscription.get('current_period_end'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_end') else timezone.now() + timedelta(days=30),
-                            'trial_start': datetime.fromtimestamp(stripe_subscription.get('trial_start'), tz=dt_timezone.utc) if stripe_subscription.get('trial_start') else None,
-                            'trial_end': datetime.fromtimestamp(stripe_subscription.get('trial_end'), tz=dt_timezone.utc) if stripe_subscription.get('trial_end') else None,
-                        }
-                    )
-
-                    if not created:
-                        # Update existing fields in case they're out of sync
-                        subscription.stripe_subscription_id = stripe_subscription.id
-                        subscription.plan = plan
-                        subscription.stripe_customer_id = stripe_subscription.customer
-                        subscription.status = stripe_subscription.status
-                        subscription.current_period_start = datetime.fromtimestamp(stripe_subscription.get('current_period_start'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_start') else timezone.now()
-                        subscription.current_period_end = datetime.fromtimestamp(stripe_subscription.get('current_period_end'), tz=dt_timezone.utc) if stripe_subscription.get('current_period_end') else timezone.now() + timedelta(days=30)
-                        subscription.trial_start = datetime.fromtimestamp(stripe_subscription.get('trial_start'), tz=dt_timezone.utc) if stripe_subscription.get('trial_start') else None
-                        subscription.trial_end = datetime.fromtimestamp(stripe_subscription.get('trial_end'), tz=dt_timezone.utc) if stripe_subscription.get('trial_end') else None
-                        subscription.save()
-                        logger.info(f"Updated subscription {subscription.id} for user {user.email}")
-                    else:
-                        logger.info(f"Created new subscription {subscription.id} for user {user.email}")
-
-
-                except stripe.error.InvalidRequestError as e:
-                    logger.error(f"Subscription {subscription_id} not found in Stripe: {str(e)}")
-                    return
-                except Exception as e:
-                    logger.error(f"Error retrieving subscription from Stripe: {str(e)}")
-                    traceback.print_exc()
-                    return
-                
-                # Allocate credits for the subscription
-                CreditService.allocate_credits_for_new_subscription(user, subscription)
-                
-                logger.info(f"Updated existing subscription for user {user.email}")
-                return
-                
-        except Exception as e:
-            logger.error(f"Error handling checkout.session.completed: {e}")
-            traceback.print_exc()
-            return
-
-    def handle_invoice_created(self, invoice_data):
-        """Handle invoice.created webhook"""
-        try:
-            subscription = Subscription.objects.get(stripe_subscription_id=invoice_data['subscription'])
-            
-            # Create invoice record
-            invoice = Invoice.objects.create(
-                subscription=subscription,
-                stripe_invoice_id=invoice_data['id'],
-                amount=invoice_data['amount_due'] / 100,  # Convert from cents
-                currency=invoice_data['currency'],
-                status=invoice_data['status'],
-                invoice_pdf=invoice_data.get('invoice_pdf'),
-                hosted_invoice_url=invoice_data.get('hosted_invoice_url')
-            )
-            
-            logger.info(f"Invoice created for user {subscription.user.email}")
-            
-        except Subscription.DoesNotExist:
-            logger.error(f"Subscription {invoice_data['subscription']} not found")
-        except Exception as e:
-            logger.error(f"Error handling invoice.created: {e}")
-
-    def handle_payment_method_attached(self, payment_method_data):
-        """Handle payment_method.attached webhook"""
+        except IntegrityError:
+            cache.set(seen_key, True, STRIPE_EVENT_SEEN_CACHE_TTL)
+            return HttpResponse(status=200)
+        except DatabaseError as e:
+            logger.error(f"Error recording webhook {event_type}: {e}")
+            return HttpResponse(status=500)
+        
+        # The claim is committed, so hand the work to Celery and acknowledge right away
         try:
-            customer_id = payment_method_data['customer']
-            payment_method_id = payment_method_data['id']
-            
-            # Find user by customer ID through subscription
-            user = None
-            try:
-                subscription = Subscription.objects.get(stripe_customer_id=customer_id)
-                user = subscription.user
-            except Subscription.DoesNotExist:
-                # If subscription doesn't exist yet, try to find user by email from Stripe customer
-                try:
-                    customer = stripe.Customer.retrieve(customer_id)
-                    if customer.email:
-                        user = User.objects.get(email=customer.email)
-                        logger.info(f"Found user {user.email} by email for customer {customer_id}")
-                    else:
-                        logger.error(f"No email found for customer {customer_id}")
-                        return
-                except (User.DoesNotExist, stripe.error.StripeError) as e:
-                    logger.error(f"Could not find user for customer {customer_id}: {e}")
-                    return
-            
-            # Save payment method
-            payment_method = PaymentMethod.objects.create(
-                user=user,
-                stripe_payment_method_id=payment_method_id,
-                card_brand=payment_method_data['card']['brand'],
-                card_last4=payment_method_data['card']['last4'],
-                card_exp_month=payment_method_data['card']['exp_month'],
-                card_exp_year=payment_method_data['card']['exp_year'],
-                is_default=True
-            )
-            
-            logger.info(f"Payment method attached for user {user.email}")
-            
+            handle_stripe_event.delay(event['id'], event_type, event_data)
         except Exception as e:
-            logger.error(f"Error handling payment_method.attached: {e}")
+            logger.error(f"Error queueing webhook {event_type}: {e}")
+            # Release the claim so Stripe's retry is processed
+            WebhookEvent.objects.filter(stripe_event_id=event['id']).delete()
+            return HttpResponse(status=500)
+        
+        # Only mark the event seen once it is recorded and queued, so a failed attempt is retried
+        cache.set(seen_key, True, STRIPE_EVENT_SEEN_CACHE_TTL)
+        return HttpResponse(status=200)
 
-class BillingPortalView(APIView):
+class BillingPortalView(BillingErrorHandlingMixin, APIView):
     permission_classes = [IsAuthenticated]
     
     def post(self, request):
@@ -821,17 +505,26 @@ class BillingPortalView(APIView):
             )
             
             return Response({'url': session.url})
-        except Exception as e:
+        except stripe.error.APIConnectionError as e:
+            logger.error(f"Stripe unreachable creating billing portal session: {e}")
+            return Response({'error': 'Billing portal is temporarily unavailable'}, status=503)
+        except stripe.error.StripeError as e:
             logger.error(f"Error creating billing portal session: {e}")
             return Response({'error': 'Failed to create billing portal session'}, status=500)
 
 # Credit System Views
-class CreditBalanceView(APIView):
+class CreditBalanceView(BillingErrorHandlingMixin, APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
         """Get user's credit balance and usage summary"""
         try:
+            # Serve from cache while fresh; writes to the balance invalidate it
+            cache_key = CreditService.get_usage_summary_cache_key(request.user.id)
+            summary = cache.get(cache_key)
+            if summary is not None:
+                return Response(summary)
+            
             summary = CreditService.get_usage_summary(request.user)
             
             # Add trial information
@@ -843,13 +536,16 @@ class CreditBalanceView(APIView):
                 'trial_restrictions': trial_restrictions
             })
             
+            cache.set(cache_key, summary, CREDIT_SUMMARY_CACHE_TTL)
             return Response(summary)
-        except Exception as e:
+        except DatabaseError as e:
             logger.error(f"Error getting credit balance: {e}")
             return Response({'error': 'Failed to get credit balance'}, status=500)
 
-class CreditUsageView(APIView):
+class CreditUsageView(BillingErrorHandlingMixin, APIView):
     permission_classes = [IsAuthenticated]
+    # Rejected with 429 and Retry-After before any credit accounting runs
+    throttle_classes = [CreditUsageBurstThrottle, CreditUsageThrottle]
     
     def post(self, request):
         """Deduct credits for AI model usage"""
@@ -867,37 +563,35 @@ class CreditUsageView(APIView):
                 return Response(result)
             except ValueError as e:
                 return Response({'error': str(e)}, status=400)
-            except Exception as e:
-                logger.error(f"Error deducting credits: {e}")
-                return Response({'error': 'Failed to deduct credits'}, status=500)
         return Response(serializer.errors, status=400)
 
-class CreditUsageLogView(APIView):
+class CreditUsageLogView(BillingErrorHandlingMixin, APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
         """Get user's credit usage logs"""
         try:
             logs = CreditUsageLog.objects.filter(user=request.user).order_by('-created_at')
-            serializer = CreditUsageLogSerializer(logs, many=True)
-            return Response(serializer.data)
-        except Exception as e:
+            # Clients that page get a bounded response; the plain list stays for existing callers
+            if request.query_params.get('page'):
+                paginator = PageNumberPagination()
+                paginator.page_size = CREDIT_USAGE_LOG_PAGE_SIZE
+                page = paginator.paginate_queryset(credit_usage_log_rows(logs), request)
+                return paginator.get_paginated_response([format_credit_usage_log(row) for row in page])
+            return Response([format_credit_usage_log(row) for row in credit_usage_log_rows(logs)])
+        except DatabaseError as e:
             logger.error(f"Error getting credit usage logs: {e}")
             return Response({'error': 'Failed to get usage logs'}, status=500)
 
 class AdminCreditAdjustmentView(APIView):
-    permission_classes = [IsAuthenticated]
+    permission_classes = [IsAuthenticated, IsAdminUser]
     
     def post(self, request):
         """Admin function to adjust user credits"""
-        # Check if user is admin
-        if not request.user.is_staff:
-            return Response({'error': 'Admin access required'}, status=403)
-        
         serializer = AdminCreditAdjustmentSerializer(data=request.data)
         if serializer.is_valid():
             try:
-                user = User.objects.get(id=serializer.validated_data['user_id'])
+                user = User.objects.select_related('credit_balance').get(id=serializer.validated_data['user_id'])
                 credits_to_add = serializer.validated_data['credits_to_add']
                 reason = serializer.validated_data.get('reason', 'Admin adjustment')
                 
@@ -917,15 +611,11 @@ class AdminCreditAdjustmentView(APIView):
                 return Response({'error': 'Failed to adjust credits'}, status=500)
         return Response(serializer.errors, status=400)
 
-class AdminCreditUsageView(APIView):
-    permission_classes = [IsAuthenticated]
+class AdminCreditUsageView(BillingErrorHandlingMixin, APIView):
+    permission_classes = [IsAuthenticated, IsAdminUser]
     
     def get(self, request):
         """Admin function to view all credit usage"""
-        # Check if user is admin
-        if not request.user.is_staff:
-            return Response({'error': 'Admin access required'}, status=403)
-        
         try:
             user_id = request.query_params.get('user_id')
             if user_id:
@@ -933,8 +623,32 @@ class AdminCreditUsageView(APIView):
             else:
                 logs = CreditUsageLog.objects.all().order_by('-created_at')
             
-            serializer = CreditUsageLogSerializer(logs, many=True)
-            return Response(serializer.data)
-        except Exception as e:
+            # Aggregate per user and model in the database instead of returning raw rows
+            if request.query_params.get('aggregate'):
+                totals = list(logs.values('user', 'model', model_name=F('model__name')).annotate(
+                    total_cost=Sum('cost_usd'),
+                    total_credits=Sum('credits_deducted'),
+                    total_input_tokens=Sum('input_tokens'),
+                    total_output_tokens=Sum('output_tokens'),
+                    calls=Count('id')
+                ).order_by('-total_cost'))
+                for row in totals:
+                    row['total_cost'] = f"{row['total_cost']:f}"
+                    row['total_credits'] = f"{row['total_credits']:f}"
+                return Response(totals)
+            
+            # Admin screens browse page by page; only full exports stream the table
+            if request.query_params.get('page'):
+                paginator = PageNumberPagination()
+                paginator.page_size = CREDIT_USAGE_LOG_PAGE_SIZE
+                page = paginator.paginate_queryset(credit_usage_log_rows(logs, 'user'), request)
+                return paginator.get_paginated_response([format_credit_usage_log(row) for row in page])
+            
+            # The unfiltered export can be the whole table, so stream it in chunks
+            return StreamingHttpResponse(
+                stream_credit_usage_logs(logs, 'user'),
+                content_type='application/json'
+            )
+        except DatabaseError as e:
             logger.error(f"Error getting admin credit usage: {e}")
             return Response({'error': 'Failed to get usage data'}, status=500)
\ No newline at end of file
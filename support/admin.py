@@ -28,11 +28,13 @@ class SupportTicketAdmin(admin.ModelAdmin):
     )
     
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('user', 'assigned_to')
+        # The changelist never shows the long text columns; the change form loads them on demand
+        return super().get_queryset(request).select_related('user', 'assigned_to').defer('description', 'internal_notes')
 
 @admin.register(SupportTicketAttachment)
 class SupportTicketAttachmentAdmin(admin.ModelAdmin):
     list_display = ('filename', 'ticket', 'uploaded_at')
+    list_select_related = ('ticket',)
     search_fields = ('filename', 'ticket__subject')
     list_filter = ('uploaded_at',)
 
@@ -0,0 +1,23 @@
+# Generated by Django 5.0 on 2026-10-16 23:26
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0004_remove_supportticket_priority_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='supportticket',
+            index=models.Index(fields=['user', '-created_at'], name='ticket_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='supportticket',
+            index=models.Index(fields=['user', 'status'], name='ticket_user_status_idx'),
+        ),
+    ]
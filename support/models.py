@@ -43,16 +43,23 @@ class SupportTicket(models.Model):
         ordering = ['-created_at']
         verbose_name = 'Support Ticket'
         verbose_name_plural = 'Support Tickets'
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='ticket_user_created_idx'),
+            models.Index(fields=['user', 'status'], name='ticket_user_status_idx'),
+        ]
     
     def __str__(self):
         return f"#{self.id} - {self.subject}"
     
-    def save(self, *args, **kwargs):
-        # Set resolved_at when status changes to resolved
-        if self.status == 'resolved' and not self.resolved_at:
+    def save(self, *args, update_fields=None, **kwargs):
+        # Set resolved_at when status changes to resolved; a partial save that
+        # leaves status alone can't resolve the ticket, so it skips the check
+        if (update_fields is None or 'status' in update_fields) and self.status == 'resolved' and not self.resolved_at:
             self.resolved_at = timezone.now()
+            if update_fields is not None:
+                update_fields = {*update_fields, 'resolved_at'}
         
-        super().save(*args, **kwargs)
+        super().save(*args, update_fields=update_fields, **kwargs)
 
 class SupportTicketAttachment(models.Model):
     ticket = models.ForeignKey(SupportTicket, on_delete=models.CASCADE, related_name='attachments')
@@ -1,6 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
 from rest_framework import serializers
+from django.db import transaction
 from .models import SupportTicket, SupportTicketAttachment
 
+# Built once at import; validate_category runs on every create and update
+VALID_CATEGORIES = frozenset(choice[0] for choice in SupportTicket.CATEGORY_CHOICES)
+
+# Upper bound on attachments written to storage at once
+ATTACHMENT_UPLOAD_WORKERS = 8
+
+def store_attachment(attachment_file):
+    """Write an uploaded file to the attachment storage and return its stored name"""
+    field = SupportTicketAttachment._meta.get_field('file')
+    return field.storage.save(field.generate_filename(None, attachment_file.name), attachment_file)
+
+def delete_stored_attachments(stored_names):
+    """Remove files written by store_attachment whose rows were never committed"""
+    storage = SupportTicketAttachment._meta.get_field('file').storage
+    for stored_name in stored_names:
+        storage.delete(stored_name)
+
 class SupportTicketAttachmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = SupportTicketAttachment
@@ -31,8 +50,7 @@ class SupportTicketSerializer(serializers.ModelSerializer):
         ]
     
     def validate_category(self, value):
-        valid_categories = [choice[0] for choice in SupportTicket.CATEGORY_CHOICES]
-        if value not in valid_categories:
+        if value not in VALID_CATEGORIES:
             raise serializers.ValidationError("Invalid category")
         return value
 
@@ -58,23 +76,36 @@ class SupportTicketCreateSerializer(serializers.ModelSerializer):
         logger.info(f"User: {user.email}")
         logger.info(f"Attachments: {len(attachments_data)} files")
         
+        stored_names = []
         try:
-            # Create the ticket
-            ticket = SupportTicket.objects.create(user=user, **validated_data)
-            logger.info(f"Ticket created with ID: {ticket.id}")
+            # Uploads are I/O bound, so write them to storage side by side, and before the
+            # transaction opens so no connection is held across the network writes
+            if attachments_data:
+                with ThreadPoolExecutor(max_workers=min(ATTACHMENT_UPLOAD_WORKERS, len(attachments_data))) as executor:
+                    uploads = [executor.submit(store_attachment, attachment_file) for attachment_file in attachments_data]
+                # Note every file that reached storage before surfacing a failed upload
+                stored_names.extend(upload.result() for upload in uploads if upload.exception() is None)
+                for upload in uploads:
+                    upload.result()
             
-            # Create attachments
-            for attachment_file in attachments_data:
-                SupportTicketAttachment.objects.create(
-                    ticket=ticket,
-                    file=attachment_file,
-                    filename=attachment_file.name
-                )
-                logger.info(f"Attachment created: {attachment_file.name}")
+            # A failed attachment must not leave a ticket behind
+            with transaction.atomic():
+                # Create the ticket
+                ticket = SupportTicket.objects.create(user=user, **validated_data)
+                logger.info(f"Ticket created with ID: {ticket.id}")
+                
+                SupportTicketAttachment.objects.bulk_create([
+                    SupportTicketAttachment(ticket=ticket, file=stored_name, filename=attachment_file.name)
+                    for attachment_file, stored_name in zip(attachments_data, stored_names)
+                ], batch_size=100)
+                if attachments_data:
+                    logger.info(f"Created {len(attachments_data)} attachments for ticket {ticket.id}")
             
             return ticket
         except Exception as e:
             logger.error(f"Error in ticket creation: {e}", exc_info=True)
+            # No rows reference the stored files once the ticket is rolled back or never created
+            delete_stored_attachments(stored_names)
             raise
 
 # SupportTicketResponseCreateSerializer removed - responses will be handled via email 
\ No newline at end of file
@@ -1,3 +1,131 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.urls import reverse
+from django.contrib.auth import get_user_model
+from rest_framework.test import APITestCase
+from rest_framework import status
+from .models import SupportTicket, SupportTicketAttachment
 
-# Create your tests here.
+User = get_user_model()
+
+class SupportTicketViewTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            full_name='Test User'
+        )
+        self.agent = User.objects.create_user(
+            email='agent@example.com',
+            password='testpass123',
+            full_name='Support Agent'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def create_ticket(self, user=None):
+        ticket = SupportTicket.objects.create(
+            user=user or self.user,
+            subject='Billing question',
+            description='Charged twice',
+            category='billing',
+            assigned_to=self.agent
+        )
+        SupportTicketAttachment.objects.create(ticket=ticket, file='support_attachments/receipt.pdf', filename='receipt.pdf')
+        return ticket
+
+    def test_ticket_list_query_count_does_not_grow_with_tickets(self):
+        for _ in range(3):
+            self.create_ticket()
+        # One query for the tickets with both users joined, one for the attachments
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('support-ticket-list'))
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual(response.data[0]['assigned_to_email'], 'agent@example.com')
+        self.assertEqual(response.data[0]['attachments'][0]['filename'], 'receipt.pdf')
+
+    def test_ticket_list_pages_when_asked(self):
+        for _ in range(3):
+            self.create_ticket()
+        with patch('support.views.SUPPORT_TICKET_PAGE_SIZE', 2):
+            response = self.client.get(reverse('support-ticket-list'), {'page': 1})
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNotNone(response.data['next'])
+
+    def test_partial_save_of_status_also_writes_resolved_at(self):
+        ticket = self.create_ticket()
+        ticket.status = 'resolved'
+        ticket.save(update_fields=['status'])
+        ticket.refresh_from_db()
+        self.assertIsNotNone(ticket.resolved_at)
+
+    def test_other_users_ticket_is_not_found(self):
+        ticket = self.create_ticket(user=self.agent)
+        response = self.client.get(reverse('support-ticket-detail', args=[ticket.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_ticket_attachments_are_inserted_together(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        files = [SimpleUploadedFile(f'log{i}.txt', b'trace') for i in range(3)]
+        with override_settings(MEDIA_ROOT=media_root):
+            response = self.client.post(reverse('support-ticket-list'), {
+                'subject': 'Bot offline',
+                'description': 'Stopped replying',
+                'category': 'technical_issue',
+                'attachments': files
+            }, format='multipart')
+            stored = SupportTicketAttachment.objects.filter(ticket_id=response.data['id']).first()
+            with stored.file.open('rb') as f:
+                self.assertEqual(f.read(), b'trace')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            sorted(SupportTicketAttachment.objects.filter(ticket_id=response.data['id']).values_list('filename', flat=True)),
+            ['log0.txt', 'log1.txt', 'log2.txt']
+        )
+        self.assertEqual(len(response.data['attachments']), 3)
+
+    @patch('support.serializers.SupportTicketAttachment.objects.bulk_create', side_effect=RuntimeError('db down'))
+    def test_failed_ticket_removes_stored_attachments(self, mock_bulk_create):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        files = [SimpleUploadedFile(f'log{i}.txt', b'trace') for i in range(2)]
+        with override_settings(MEDIA_ROOT=media_root):
+            response = self.client.post(reverse('support-ticket-list'), {
+                'subject': 'Bot offline',
+                'description': 'Stopped replying',
+                'category': 'technical_issue',
+                'attachments': files
+            }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertFalse(SupportTicket.objects.exists())
+        stored = [name for _, _, names in os.walk(media_root) for name in names]
+        self.assertEqual(stored, [])
+
+    def test_attachments_are_stored_before_the_ticket_is_created(self):
+        events = []
+        create_ticket = SupportTicket.objects.create
+        
+        def record_store(attachment_file):
+            events.append('store')
+            return f'support_attachments/{attachment_file.name}'
+        
+        def record_create(**kwargs):
+            events.append('ticket')
+            return create_ticket(**kwargs)
+        
+        with patch('support.serializers.store_attachment', side_effect=record_store), \
+                patch('support.serializers.SupportTicket.objects.create', side_effect=record_create):
+            response = self.client.post(reverse('support-ticket-list'), {
+                'subject': 'Bot offline',
+                'description': 'Stopped replying',
+                'category': 'technical_issue',
+                'attachments': [SimpleUploadedFile(f'log{i}.txt', b'trace') for i in range(2)]
+            }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # Storage writes finish before the transaction that inserts the ticket opens
+        self.assertEqual(events, ['store', 'store', 'ticket'])
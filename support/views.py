@@ -2,12 +2,10 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.pagination import PageNumberPagination
 from django.shortcuts import get_object_or_404
 from django.core.exceptions import ObjectDoesNotExist
 import logging
-import json
-import redis
-from django.conf import settings
 from .models import SupportTicket
 from .serializers import (
     SupportTicketSerializer, 
@@ -16,22 +14,29 @@ from .serializers import (
 
 logger = logging.getLogger(__name__)
 
-def publish_to_redis(channel, payload):
-    """Publish message to Redis for real-time updates"""
-    try:
-        r = redis.Redis.from_url(settings.REDIS_URL)
-        r.publish(channel, json.dumps(payload))
-        logger.info(f"Published to Redis channel {channel}: {payload}")
-    except Exception as e:
-        logger.error(f"Failed to publish to Redis: {e}")
+# Tickets returned per page of SupportTicketListView when a page is requested
+SUPPORT_TICKET_PAGE_SIZE = 50
+
+def ticket_queryset(user):
+    """The user's tickets with everything SupportTicketSerializer reads loaded up front"""
+    return SupportTicket.objects.filter(user=user).select_related('user', 'assigned_to').prefetch_related('attachments')
 
 class SupportTicketListView(APIView):
     permission_classes = [IsAuthenticated]
     
+    def get_queryset(self):
+        return ticket_queryset(self.request.user)
+    
     def get(self, request):
         """Get all tickets for the current user"""
         try:
-            tickets = SupportTicket.objects.filter(user=request.user)
+            tickets = self.get_queryset()
+            # Clients that page get a bounded response; the plain list stays for existing callers
+            if request.query_params.get('page'):
+                paginator = PageNumberPagination()
+                paginator.page_size = SUPPORT_TICKET_PAGE_SIZE
+                page = paginator.paginate_queryset(tickets, request)
+                return paginator.get_paginated_response(SupportTicketSerializer(page, many=True).data)
             serializer = SupportTicketSerializer(tickets, many=True)
             return Response(serializer.data)
         except Exception as e:
@@ -67,19 +72,17 @@ class SupportTicketListView(APIView):
 class SupportTicketDetailView(APIView):
     permission_classes = [IsAuthenticated]
     
-    def get_object(self, ticket_id, user):
+    def get_queryset(self):
+        return ticket_queryset(self.request.user)
+    
+    def get_object(self, ticket_id):
         """Get ticket and verify ownership"""
-        try:
-            ticket = SupportTicket.objects.get(id=ticket_id)
-            if ticket.user != user:
-                return None
-            return ticket
-        except SupportTicket.DoesNotExist:
-            return None
+        # get_queryset is scoped to the user, so ownership is checked in the same query
+        return self.get_queryset().filter(id=ticket_id).first()
     
     def get(self, request, ticket_id):
         """Get a specific ticket"""
-        ticket = self.get_object(ticket_id, request.user)
+        ticket = self.get_object(ticket_id)
         if not ticket:
             return Response({'error': 'Ticket not found'}, status=status.HTTP_404_NOT_FOUND)
         
@@ -95,7 +98,7 @@ class SupportTicketDetailView(APIView):
     
     def patch(self, request, ticket_id):
         """Update a ticket (limited fields for users)"""
-        ticket = self.get_object(ticket_id, request.user)
+        ticket = self.get_object(ticket_id)
         if not ticket:
             return Response({'error': 'Ticket not found'}, status=status.HTTP_404_NOT_FOUND)
         